@@ -1,9 +1,14 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, TypeVar
+
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message, WebAppInfo
-from sqlalchemy import select
+from aiogram.types import CallbackQuery, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup, Message, WebAppInfo
+from sqlalchemy import select, update
 
 from .config import settings
 from .database import AsyncSessionLocal
@@ -29,6 +34,91 @@ session = AiohttpSession(timeout=60)
 bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"), session=session)
 dp = Dispatcher()
 
+T = TypeVar("T")
+
+
+class SendRateLimiter:
+    """
+    Темп отправки под лимиты Bot API: не больше per_second сообщений в секунду всего
+    и не чаще раза в per_chat_interval секунд в один чат. pause() останавливает всех
+    отправителей на время retry_after из ответа Telegram.
+    """
+
+    def __init__(self, per_second: float, per_chat_interval: float = 1.0):
+        self.interval = 1 / per_second
+        self.per_chat_interval = per_chat_interval
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._chat_next: dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def wait(self, chat_id: int) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until, self._chat_next.get(chat_id, 0.0))
+            self._next_slot = slot + self.interval
+            self._chat_next[chat_id] = slot + self.per_chat_interval
+            if len(self._chat_next) > 10_000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        delay = slot - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+send_limiter = SendRateLimiter(settings.broadcast_rate_per_second)
+
+
+async def send_limited(chat_id: int, send: Callable[[], Awaitable[T]], attempts: int = 3) -> T:
+    """Отправка через send_limiter; на TelegramRetryAfter ждёт указанное время и повторяет."""
+    for attempt in range(attempts):
+        await send_limiter.wait(chat_id)
+        try:
+            return await send()
+        except TelegramRetryAfter as exc:
+            send_limiter.pause(exc.retry_after)
+            if attempt == attempts - 1:
+                raise
+    raise RuntimeError("unreachable")
+
+
+def is_unreachable_error(exc: BaseException) -> bool:
+    """Пользователь заблокировал бота, удалил аккаунт или чат не существует — повторять бессмысленно."""
+    if isinstance(exc, TelegramForbiddenError):
+        return True
+    if isinstance(exc, TelegramBadRequest):
+        text = (exc.message or "").lower()
+        return "chat not found" in text or "user is deactivated" in text
+    return False
+
+
+async def set_reachable(telegram_id: int | str, reachable: bool) -> None:
+    async with AsyncSessionLocal() as session:
+        query = update(models.User).where(models.User.telegram_id == str(telegram_id))
+        if reachable:
+            query = query.where(models.User.bot_blocked_at.is_not(None)).values(bot_blocked_at=None)
+        else:
+            query = query.values(bot_blocked_at=now_utc())
+        await session.execute(query)
+        await session.commit()
+
+
+async def mark_reachable_middleware(handler, event: Any, data: dict):
+    # любое сообщение или нажатие от пользователя значит, что до него снова можно достучаться
+    user = getattr(event, "from_user", None)
+    if user:
+        try:
+            await set_reachable(user.id, True)
+        except Exception:
+            pass
+    return await handler(event, data)
+
+
+dp.message.outer_middleware(mark_reachable_middleware)
+dp.callback_query.outer_middleware(mark_reachable_middleware)
+
 
 async def is_subscribed(user_id: int) -> bool:
     """???????? ???????? ?? ?????, ???? ?????? REQUIRED_CHANNEL."""
@@ -96,6 +186,17 @@ async def cb_accept_policy(query: CallbackQuery):
     await query.answer()
 
 
+@dp.my_chat_member()
+async def on_my_chat_member(event: ChatMemberUpdated):
+    if event.chat.type != "private":
+        return
+    status = event.new_chat_member.status
+    if status == "kicked":
+        await set_reachable(event.chat.id, False)
+    elif status == "member":
+        await set_reachable(event.chat.id, True)
+
+
 @dp.callback_query(F.data.startswith("admin_login:"))
 async def cb_admin_login(query: CallbackQuery):
     parts = (query.data or "").split(":")
@@ -6,10 +6,32 @@ class Settings(BaseSettings):
     webapp_url: str
     yookassa_shop_id: str
     yookassa_secret_key: str
+    yookassa_workers: int = 8  # потоков для синхронного SDK YooKassa
+    yookassa_reconcile_workers: int = 2  # отдельные потоки сверки платежей, чтобы не занимать пул пополнений
+    yookassa_timeout: float = 15.0  # сек, таймаут соединения и чтения для запросов SDK
+    yookassa_max_attempts: int = 2
+    yookassa_api_url: str = "https://api.yookassa.ru/v3"  # для локальной заглушки: yookassa_stub.py
     payment_return_url: str | None = None
     admin_secret: str
     admin_tg_id: str | None = None
     database_url: str = "sqlite+aiosqlite:///./data.db"
+    database_read_url: str | None = None  # реплика для запросов только на чтение
+    read_replica_max_lag: float = 2.0  # сек: столько после записи данные пользователя читаются из основной БД
+    # профиль SQLite, применяется к каждому новому соединению
+    sqlite_profile: bool = True
+    sqlite_journal_mode: str = "WAL"  # читатели не блокируют писателя
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_synchronous: str = "NORMAL"  # с WAL надёжно и без fsync на каждый commit
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64000  # отрицательное — в КиБ (~64 МБ)
+    sqlite_temp_store: str = "MEMORY"
+    # пул соединений для PostgreSQL (postgresql+asyncpg://...); для SQLite не применяется
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_statement_cache_size: int = 500  # подготовленные запросы на соединение; 0 — за pgbouncer в режиме transaction
     support_username: str = "support"
     required_channel: str | None = None  # формат @channel или username
     policy_url: str | None = None
@@ -17,11 +39,47 @@ class Settings(BaseSettings):
     android_help_url: str = "https://telegra.ph/android-vpn-install"
     domain: str = "the1priority.ru"
     price_per_day: float = 10.0
+    billing_concurrency: int = 10  # одновременных запросов к панели при списании
+    billing_batch_size: int = 500
+    expiry_sweep_interval: int = 300  # сек
+    expiry_sweep_batch: int = 500
+    expiry_warn_days: int = 3
+    counters_check_interval: int = 3600  # сек, сверка денормализованных счётчиков с COUNT
+    job_poll_interval: int = 2  # сек, как часто лидер проверяет очередь фоновых задач
+    recompute_batch_size: int = 500
+    broadcast_rate_per_second: float = 25.0  # общий лимит Telegram ~30 сообщений/сек
+    broadcast_concurrency: int = 20
+    broadcast_batch_size: int = 200
+    upload_dir: str = "uploads"
+    broadcast_photo_max_bytes: int = 10 * 1024 * 1024  # лимит Bot API на фото
+    outbox_poll_interval: int = 2  # сек, как часто диспетчер уведомлений проверяет очередь
+    outbox_batch_size: int = 100
+    outbox_max_attempts: int = 5
+    outbox_retention_days: int = 30  # сколько хранить отправленные (ключи дедупликации)
+    webhook_poll_interval: int = 1  # сек
+    webhook_batch_size: int = 50
+    webhook_concurrency: int = 5
+    webhook_max_attempts: int = 8  # после этого событие уходит в dead-letter
+    webhook_retention_days: int = 30
+    payment_reconcile_interval: int = 300  # сек
+    payment_reconcile_after_minutes: int = 15  # pending дольше этого проверяется у провайдера
+    payment_expire_after_hours: int = 24  # неоплаченные дольше этого помечаются expired
+    payment_reconcile_batch: int = 200
+    payment_reconcile_concurrency: int = 5
+    idempotency_ttl: int = 24 * 3600  # сек, сколько хранится ответ для Idempotency-Key
+    idempotency_processing_ttl: int = 120  # сек; незавершённый запрос старше этого считается оборванным
+    idempotency_purge_interval: int = 3600  # сек, удаление истёкших Idempotency-Key
+    leader_lease_ttl: int = 30  # сек; после смерти лидера другой процесс подхватит задачи через это время
+    leader_renew_interval: int = 10  # задачи лидера останавливаются через leader_lease_ttl - это время без продления
     rem_base_url: str = ""
     rem_api_token: str = ""
     crypto_pay_token: str = ""
     crypto_pay_asset: str = "USDT"
     crypto_rate: float = 0.0  # рублей за 1 единицу актива (например, 100 = 100₽ за 1 USDT/TON)
+    crypto_pay_api_url: str = "https://pay.crypt.bot/api"
+    crypto_rate_ttl: int = 600  # сек; старше — курс запрашивается заново (или берётся crypto_rate)
+    crypto_rate_refresh_interval: int = 60
+    crypto_invoice_expires_in: int = 3600
 
     model_config = {
         "env_file": ".env",
@@ -0,0 +1,98 @@
+"""
+Асинхронный клиент Crypto Pay API (@CryptoBot) на общем пуле соединений aiohttp.
+Курсы обмена кэшируются: их обновляет фоновая задача, пополнение не ждёт запроса курса.
+"""
+import asyncio
+import time
+from typing import Any, Optional
+
+import aiohttp
+
+from .config import settings
+
+
+class CryptoPayError(Exception):
+    pass
+
+
+class CryptoPayClient:
+    def __init__(self, token: str, base_url: str, rate_ttl: int):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.rate_ttl = rate_ttl
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._rates: dict[str, float] = {}  # актив -> рублей за 1 единицу
+        self._rates_at = 0.0
+        self._rates_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token)
+
+    def session(self) -> aiohttp.ClientSession:
+        # одна сессия на процесс: соединения с pay.crypt.bot переиспользуются
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Crypto-Pay-API-Token": self.token},
+                timeout=aiohttp.ClientTimeout(total=15),
+                connector=aiohttp.TCPConnector(limit=20),
+            )
+        return self._session
+
+    async def call(self, method: str, **params: Any) -> Any:
+        async with self.session().post(f"{self.base_url}/{method}", json=params) as resp:
+            data = await resp.json(content_type=None)
+        if not data.get("ok"):
+            raise CryptoPayError(f"{method}: {data.get('error')}")
+        return data["result"]
+
+    async def create_invoice(self, asset: str, amount: str, payload: str, description: str) -> dict:
+        return await self.call(
+            "createInvoice",
+            asset=asset,
+            amount=amount,
+            payload=payload,
+            description=description,
+            expires_in=settings.crypto_invoice_expires_in,
+        )
+
+    async def get_invoice(self, invoice_id: str) -> Optional[dict]:
+        result = await self.call("getInvoices", invoice_ids=str(invoice_id))
+        items = result.get("items", []) if isinstance(result, dict) else result
+        return items[0] if items else None
+
+    async def refresh_rates(self) -> dict[str, float]:
+        rates = await self.call("getExchangeRates")
+        self._rates = {
+            r["source"]: float(r["rate"]) for r in rates if r.get("is_valid") and r.get("target") == "RUB"
+        }
+        self._rates_at = time.monotonic()
+        return self._rates
+
+    async def rub_rate(self, asset: str) -> Optional[float]:
+        """Рублей за 1 единицу актива из кэша; запрос к API только если фоновое обновление не успело."""
+        if time.monotonic() - self._rates_at > self.rate_ttl or asset not in self._rates:
+            async with self._rates_lock:
+                if time.monotonic() - self._rates_at > self.rate_ttl:
+                    try:
+                        await self.refresh_rates()
+                    except Exception:  # noqa: BLE001
+                        pass
+        return self._rates.get(asset) or settings.crypto_rate or None
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+cryptopay = CryptoPayClient(settings.crypto_pay_token, settings.crypto_pay_api_url, settings.crypto_rate_ttl)
+
+
+async def crypto_rates_loop() -> None:
+    # в каждом воркере свой кэш курсов, поэтому задача не из SINGLETON_TASKS
+    while True:
+        try:
+            await cryptopay.refresh_rates()
+        except Exception:
+            pass
+        await asyncio.sleep(settings.crypto_rate_refresh_interval)
@@ -1,5 +1,11 @@
+import datetime as dt
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session
 
 from .config import settings
 
@@ -8,10 +14,139 @@ class Base(DeclarativeBase):
     pass
 
 
-engine = create_async_engine(settings.database_url, echo=False, future=True)
+IS_SQLITE = settings.database_url.startswith("sqlite")
+
+
+def sqlite_pragmas(read_only: bool = False) -> list[str]:
+    pragmas = [
+        f"PRAGMA journal_mode={settings.sqlite_journal_mode}",
+        f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}",
+        f"PRAGMA synchronous={settings.sqlite_synchronous}",
+        f"PRAGMA mmap_size={settings.sqlite_mmap_size}",
+        f"PRAGMA cache_size={settings.sqlite_cache_size}",
+        f"PRAGMA temp_store={settings.sqlite_temp_store}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+
+def use_sqlite_profile(target_engine, read_only: bool = False) -> None:
+    @event.listens_for(target_engine.sync_engine, "connect")
+    def _apply(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas(read_only):
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        return {}
+    options = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+    if "+asyncpg" in url:
+        # asyncpg готовит каждый запрос на сервере; кэш держит горячие запросы подготовленными
+        options["connect_args"] = {"prepared_statement_cache_size": settings.db_statement_cache_size}
+    return options
+
+
+engine = create_async_engine(settings.database_url, echo=False, future=True, **engine_options(settings.database_url))
+# запросы только на чтение: реплика из DATABASE_READ_URL, иначе для SQLite — отдельный пул
+# (в режиме WAL читатели не ждут писателя); PostgreSQL без реплики читает через общий пул
+READ_REPLICA = bool(settings.database_read_url)
+if READ_REPLICA:
+    read_engine = create_async_engine(
+        settings.database_read_url, echo=False, future=True, **engine_options(settings.database_read_url)
+    )
+elif IS_SQLITE and ":memory:" not in settings.database_url:
+    read_engine = create_async_engine(settings.database_url, echo=False, future=True)
+else:
+    read_engine = engine
+
+if IS_SQLITE and settings.sqlite_profile:
+    use_sqlite_profile(engine)
+if read_engine is not engine and read_engine.dialect.name == "sqlite" and settings.sqlite_profile:
+    use_sqlite_profile(read_engine, read_only=True)
+
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
 
 
 async def get_session() -> AsyncSession:
     async with AsyncSessionLocal() as session:
         yield session
+
+
+async def get_read_session() -> AsyncSession:
+    async with AsyncReadSessionLocal() as session:
+        yield session
+
+
+# пользователи, изменённые этим процессом: user_id -> time.monotonic() коммита
+_recent_writes: dict[int, float] = {}
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_written_users(session, flush_context):
+    written = session.info.setdefault("written_users", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        user_id = obj.id if getattr(obj, "__tablename__", None) == "users" else getattr(obj, "user_id", None)
+        if user_id is not None:
+            written.add(user_id)
+
+
+def note_user_write(session: AsyncSession, user_id: int) -> None:
+    """Отмечает запись данных пользователя, сделанную мимо ORM (Core UPDATE/DELETE)."""
+    session.info.setdefault("written_users", set()).add(user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _stamp_written_users(session):
+    written = session.info.pop("written_users", None)
+    if not written:
+        return
+    now = time.monotonic()
+    if len(_recent_writes) > 10_000:
+        for user_id, at in list(_recent_writes.items()):
+            if now - at > settings.read_replica_max_lag:
+                del _recent_writes[user_id]
+    for user_id in written:
+        _recent_writes[user_id] = now
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_written_users(session):
+    session.info.pop("written_users", None)
+
+
+def replica_fresh(user_id: int, updated_at: Optional[dt.datetime] = None) -> bool:
+    """
+    Можно ли читать данные пользователя с реплики. Нельзя, если он менялся не раньше чем
+    read_replica_max_lag секунд назад: этим процессом (ORM-изменения и note_user_write) или,
+    по updated_at из основной БД, любым другим — записи платежей тоже сдвигают users.updated_at.
+    """
+    if not READ_REPLICA:
+        return True
+    lag = settings.read_replica_max_lag
+    if time.monotonic() - _recent_writes.get(user_id, float("-inf")) < lag:
+        return False
+    if updated_at is not None:
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=dt.timezone.utc)
+        if (dt.datetime.now(dt.timezone.utc) - updated_at).total_seconds() < lag:
+            return False
+    return True
+
+
+@asynccontextmanager
+async def user_read_session(user_id: int, updated_at: Optional[dt.datetime] = None) -> AsyncIterator[AsyncSession]:
+    """Сессия для чтения данных пользователя: реплика, а сразу после записи — основная БД."""
+    maker = AsyncReadSessionLocal if replica_fresh(user_id, updated_at) else AsyncSessionLocal
+    async with maker() as session:
+        yield session
@@ -1,18 +1,31 @@
 import asyncio
+import base64
+import functools
+import json
+import logging
 import math
+import os
+import socket
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime, timezone
-from typing import Optional
+from decimal import ROUND_UP, Decimal
+from hashlib import sha256
+from typing import AsyncIterator, Awaitable, Callable, Optional
 
 import aiohttp
-from fastapi import Depends, FastAPI, Header, HTTPException, Request, status, UploadFile, File, Form
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response, status, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse
 
 from fastapi.staticfiles import StaticFiles
 
-from sqlalchemy import func, select, delete
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -20,18 +33,22 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import models
 
-from .bot import bot, dp, webapp_keyboard
+from .bot import bot, dp, is_unreachable_error, send_limited, webapp_keyboard
 from aiogram import types
 
 from .config import settings
 
-from .database import Base, engine, get_session, AsyncSessionLocal
+from .cryptopay import crypto_rates_loop, cryptopay
+from .database import Base, engine, get_read_session, get_session, note_user_write, user_read_session, AsyncSessionLocal
+from .metrics import metrics
+from .migrations import apply_migrations, schema_lock
 
 from .schemas import (
     AdminBalance,
     AdminBan,
     AdminBroadcast,
     AdminBroadcastPhoto,
+    AdminBroadcastSegment,
     AdminBalanceAdjust,
     AdminUserLookup,
     AdminServer,
@@ -47,7 +64,10 @@ from .schemas import (
     AdminRemSquad,
     AdminRemSquadUpdate,
     AdminRemSquadDelete,
+    AdminLedgerLookup,
+    AdminPaymentsLookup,
     DeviceRequest,
+    LedgerOut,
     PaymentRequest,
     PaymentOut,
     SubscriptionRequest,
@@ -58,7 +78,17 @@ from .schemas import (
     AdminMaintenanceAllow,
     AdminUserLookup,
 )
-from .utils import create_admin_ui_token, make_wireguard_link, new_slug, now_utc, validate_telegram_webapp_data, verify_admin_ui_token
+from .utils import (
+    create_admin_ui_token,
+    make_wireguard_link,
+    new_slug,
+    now_utc,
+    validate_telegram_webapp_data,
+    verify_admin_ui_token,
+    verify_crypto_pay_signature,
+)
+
+logger = logging.getLogger(__name__)
 
 
 async def get_price(session: AsyncSession) -> float:
@@ -72,6 +102,13 @@ async def get_price(session: AsyncSession) -> float:
     return settings.price_per_day
 
 
+def daily_charge(price_value: float, devices: int) -> int:
+    """Списание за сутки в целых рублях (баланс и журнал целочисленные). По нему же считаются оплаченные дни."""
+    if not price_value or price_value <= 0:
+        return 0
+    return int((Decimal(str(price_value)) * max(devices, 1)).to_integral_value(rounding=ROUND_UP))
+
+
 async def set_price(session: AsyncSession, value: float) -> float:
     setting = await session.get(models.AppSetting, "price_per_day")
     if setting:
@@ -118,6 +155,103 @@ async def set_maintenance_allow(session: AsyncSession, ids: list[str]) -> list[s
     return cleaned
 
 
+async def apply_balance(
+    session: AsyncSession,
+    user_id: int,
+    amount: int,
+    kind: str,
+    payment_id: Optional[int] = None,
+    comment: Optional[str] = None,
+) -> Optional[int]:
+    """
+    Единственный путь изменения баланса: UPDATE balance = balance + amount в SQL и запись в журнал
+    с balance_after из RETURNING, поэтому параллельное зачисление не теряется и журнал сходится
+    с балансом. Списание, уводящее баланс в минус, не выполняется — возвращается None.
+    Запись уходит в БД вместе с ближайшим commit.
+    """
+    query = update(models.User).where(models.User.id == user_id)
+    if amount < 0:
+        query = query.where(models.User.balance >= -amount)
+    balance_after = await session.scalar(
+        query.values(balance=models.User.balance + amount)
+        .returning(models.User.balance)
+        .execution_options(synchronize_session="fetch")
+    )
+    if balance_after is None:
+        return None
+    # UPDATE баланса сдвигает users.updated_at (onupdate)
+    note_user_write(session, user_id)
+    session.add(
+        models.BalanceLedger(
+            user_id=user_id,
+            kind=kind,
+            amount=amount,
+            balance_after=balance_after,
+            payment_id=payment_id,
+            comment=comment,
+        )
+    )
+    return balance_after
+
+
+async def touch_user(session: AsyncSession, user_id: int) -> None:
+    """Core UPDATE платежа не трогает users: сдвигаем updated_at, чтобы чтение с реплики видело запись."""
+    await session.execute(update(models.User).where(models.User.id == user_id).values(updated_at=now_utc()))
+    note_user_write(session, user_id)
+
+
+async def credit_payment(session: AsyncSession, payment: models.Payment, comment: str) -> Optional[models.User]:
+    """
+    Переводит платёж в succeeded и зачисляет сумму условными UPDATE'ами: из параллельных
+    доставок одного события зачисляет ровно одна, остальные получают None.
+    Баланс увеличивается через apply_balance.
+    """
+    result = await session.execute(
+        update(models.Payment)
+        .where(models.Payment.id == payment.id, models.Payment.status != "succeeded")
+        .values(status="succeeded")
+        .execution_options(synchronize_session="fetch")
+    )
+    if not result.rowcount:
+        return None
+    if await apply_balance(session, payment.user_id, payment.amount, models.LEDGER_TOPUP, payment.id, comment) is None:
+        return None
+    return await session.get(models.User, payment.user_id)
+
+
+async def mark_event_processed(session: AsyncSession, provider: str, event_id: str, payment_id: Optional[int]) -> bool:
+    """Записывает событие webhook'а. False — такое событие уже обработано (транзакция откатывается)."""
+    try:
+        await session.execute(
+            insert(models.ProcessedEvent).values(
+                provider=provider, event_id=event_id, payment_id=payment_id, created_at=now_utc()
+            )
+        )
+    except IntegrityError:
+        await session.rollback()
+        return False
+    return True
+
+
+async def ledger_mismatches(session: AsyncSession, limit: int = 100) -> list[dict]:
+    totals = (
+        select(models.BalanceLedger.user_id, func.sum(models.BalanceLedger.amount).label("total"))
+        .group_by(models.BalanceLedger.user_id)
+        .subquery()
+    )
+    total = func.coalesce(totals.c.total, 0)
+    rows = await session.execute(
+        select(models.User.id, models.User.telegram_id, models.User.balance, total)
+        .outerjoin(totals, totals.c.user_id == models.User.id)
+        .where(models.User.balance != total)
+        .limit(limit)
+    )
+    return [
+        {"user_id": user_id, "telegram_id": tg_id, "balance": balance, "ledger_total": ledger_total}
+        for user_id, tg_id, balance, ledger_total in rows
+    ]
+
+
 def get_rem_config() -> tuple[str, str, str]:
     if not settings.rem_base_url or not settings.rem_api_token:
         raise HTTPException(status_code=503, detail="Remnawave API is not configured")
@@ -130,14 +264,12 @@ def get_rem_config() -> tuple[str, str, str]:
 
 
 async def pick_rem_squad(session: AsyncSession) -> Optional[models.RemSquad]:
-    squads = list((await session.scalars(select(models.RemSquad))).all())
-    if not squads:
-        return None
-    for squad in squads:
-        used = await session.scalar(select(func.count(models.RemUser.id)).where(models.RemUser.squad_id == squad.id))
-        if (used or 0) < squad.capacity:
-            return squad
-    return None
+    return await session.scalar(
+        select(models.RemSquad)
+        .where(models.RemSquad.users_count < models.RemSquad.capacity)
+        .order_by(models.RemSquad.id)
+        .limit(1)
+    )
 
 
 async def check_subscription(user: models.User) -> bool:
@@ -178,23 +310,151 @@ async def rem_enable_user(panel_uuid: str) -> None:
             return
 
 
-async def rem_delete_user(panel_uuid: str) -> None:
+async def rem_delete_user(panel_uuid: str, http: Optional[aiohttp.ClientSession] = None) -> None:
     if not panel_uuid:
         return
     base_url, base_api, token = get_rem_config()
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as http:
-        async with http.delete(f"{base_api}/users/{panel_uuid}", headers=headers) as resp:
-            return
+    if http is None:
+        async with aiohttp.ClientSession() as http:
+            return await rem_delete_user(panel_uuid, http)
+    async with http.delete(f"{base_api}/users/{panel_uuid}", headers=headers) as resp:
+        return
 
 
-async def recalc_subscription(session: AsyncSession, user: models.User) -> dict:
-    devices_count = await session.scalar(
-        select(func.count(models.Device.id)).where(models.Device.user_id == user.id)
-    ) or 0
-    device_count = max(devices_count, 1)
+# SDK YooKassa синхронный (requests): вызовы идут в ограниченном пуле потоков, а не в event loop
+YOOKASSA_EXECUTOR = ThreadPoolExecutor(max_workers=settings.yookassa_workers, thread_name_prefix="yookassa")
+# сверка (reconcile_payments_once) идёт в своём пуле и не может занять потоки пополнений
+YOOKASSA_RECONCILE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=settings.yookassa_reconcile_workers, thread_name_prefix="yookassa-reconcile"
+)
+
+
+def configure_yookassa() -> None:
+    # учётные данные задаются один раз при старте, а не в каждом запросе
+    from requests.adapters import HTTPAdapter
+    from yookassa import Configuration
+    from yookassa.client import ApiClient
+
+    Configuration.configure(
+        settings.yookassa_shop_id,
+        settings.yookassa_secret_key,
+        api_url=settings.yookassa_api_url,
+        max_attempts=settings.yookassa_max_attempts,
+    )
+
+    # Configuration.timeout в SDK — только пауза между повторами, сам запрос идёт без таймаута;
+    # таймаут соединения и чтения задаёт адаптер сессии
+    class TimeoutAdapter(HTTPAdapter):
+        def send(self, request, timeout=None, **kwargs):
+            return super().send(request, timeout=timeout or settings.yookassa_timeout, **kwargs)
+
+    get_session = ApiClient.get_session
+    if getattr(get_session, "with_timeout", False):
+        return
+
+    def get_session_with_timeout(self):
+        session = get_session(self)
+        for prefix in ("https://", "http://"):
+            session.mount(prefix, TimeoutAdapter(max_retries=session.get_adapter(prefix).max_retries))
+        return session
+
+    get_session_with_timeout.with_timeout = True
+    ApiClient.get_session = get_session_with_timeout
+
+
+async def yookassa_create_payment(create_payload: dict, idempotency_key: str):
+    from yookassa import Payment
+
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        response = await asyncio.get_running_loop().run_in_executor(
+            YOOKASSA_EXECUTOR, functools.partial(Payment.create, create_payload, idempotency_key)
+        )
+        outcome = "ok"
+        return response
+    finally:
+        metrics.observe("yookassa_payment_create_seconds", time.monotonic() - started, outcome=outcome)
+
+
+async def yookassa_fetch_payment(provider_payment_id: str):
+    from yookassa import Payment
+
+    return await asyncio.get_running_loop().run_in_executor(
+        YOOKASSA_RECONCILE_EXECUTOR, Payment.find_one, provider_payment_id
+    )
+
+
+SUBSCRIPTION_PAUSED_TEXT = "Подписка приостановлена — баланс закончился. Пополните баланс, чтобы возобновить."
+SUBSCRIPTION_EXPIRING_TEXT = "У вас осталось менее 3 дней подписки. Пополните баланс, чтобы продолжить."
+
+
+async def enqueue_notification(session: AsyncSession, user: models.User, text: str, dedup_key: str) -> None:
+    """
+    Кладёт уведомление в outbox в текущей транзакции — оно уйдёт, только если изменение закоммичено.
+    Повтор с тем же dedup_key ничего не добавляет. Отправляет notification_dispatcher_loop.
+    """
+    if not user.telegram_id or user.bot_blocked_at:
+        return
+    now = now_utc()
+    # ON CONFLICT DO NOTHING атомарен: параллельная вставка того же ключа не роняет транзакцию вызывающего
+    upsert = pg_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+    await session.execute(
+        upsert(models.Notification)
+        .values(
+            user_id=user.id,
+            text=text,
+            dedup_key=dedup_key,
+            status="pending",
+            attempts=0,
+            next_attempt_at=now,
+            created_at=now,
+        )
+        .on_conflict_do_nothing(index_elements=["dedup_key"])
+    )
+
+
+def set_paid_until(user: models.User, expires_at: datetime) -> None:
+    """
+    Ставит оплаченный срок. Предупреждение «осталось меньше expiry_warn_days дней» (sweep_expiry_once)
+    уходит только при переходе через порог сверху: кто начинает период уже с коротким сроком
+    (пробный, первое пополнение, возобновление после паузы), помечается как предупреждённый.
+    Вызывать до снятия link_suspended.
+    """
+    now = now_utc()
+    prev_end = user.subscription_end
+    if prev_end is not None and prev_end.tzinfo is None:
+        prev_end = prev_end.replace(tzinfo=timezone.utc)
+    was_active = not user.link_suspended and prev_end is not None and prev_end > now
+    user.subscription_end = expires_at
+    if expires_at - now > timedelta(days=settings.expiry_warn_days):
+        user.expiry_warned_at = None
+    elif not was_active and user.expiry_warned_at is None:
+        user.expiry_warned_at = now
+
+
+async def expire_trial(session: AsyncSession, user: models.User) -> bool:
+    """Закрывает истёкший пробный период: баланс обнуляется. Возвращает True, если период истёк."""
+    if not user.trial_expires_at:
+        return False
+    trial_end = user.trial_expires_at
+    if trial_end.tzinfo is None:
+        trial_end = trial_end.replace(tzinfo=timezone.utc)
+        user.trial_expires_at = trial_end
+    if trial_end > now_utc():
+        return False
+    user.trial_expires_at = None
+    if user.balance:
+        await apply_balance(session, user.id, -user.balance, models.LEDGER_TRIAL, comment="trial expired")
+    return True
+
+
+async def recalc_subscription(session: AsyncSession, user: models.User, dry_run: bool = False) -> dict:
+    """Пересчёт подписки по балансу. dry_run — без вызовов панели и Telegram (симулятор)."""
+    device_count = max(user.devices_count or 0, 1)
     price_value = await get_price(session)
-    cost = price_value * device_count if price_value else 0
+    cost = daily_charge(price_value, device_count)
     link_value = ""
     estimated_days = 0
     rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
@@ -210,14 +470,7 @@ async def recalc_subscription(session: AsyncSession, user: models.User) -> dict:
         delta = sub_end - now_utc()
         prev_days = math.ceil(delta.total_seconds() / 86400)
 
-    if user.trial_expires_at:
-        trial_end = user.trial_expires_at
-        if trial_end.tzinfo is None:
-            trial_end = trial_end.replace(tzinfo=timezone.utc)
-            user.trial_expires_at = trial_end
-        if trial_end <= now_utc():
-            user.trial_expires_at = None
-            user.balance = 0
+    await expire_trial(session, user)
 
     # Если пользователь забанен — сразу блокируем доступ и выходим
     if user.banned:
@@ -226,7 +479,7 @@ async def recalc_subscription(session: AsyncSession, user: models.User) -> dict:
         user.link_suspended = True
         try:
             current_uuid = panel_uuid_current or short_uuid_current
-            if current_uuid:
+            if current_uuid and not dry_run:
                 await rem_disable_user(current_uuid)
         except Exception:
             pass
@@ -239,69 +492,51 @@ async def recalc_subscription(session: AsyncSession, user: models.User) -> dict:
         }
 
     if cost > 0:
-        estimated_days = int(user.balance / cost)
+        estimated_days = user.balance // cost
 
     if estimated_days <= 0:
         user.subscription_end = None
         user.allowed_devices = device_count
         user.link_suspended = True
+        user.expiry_warned_at = None
         # Удаляем пользователя из Remnawave, чтобы не занимать слот до пополнения
         try:
             rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
             current_uuid = (rem_user.panel_uuid if rem_user else "") or panel_uuid_current or short_uuid_current
-            if rem_user and current_uuid:
+            if rem_user and current_uuid and not dry_run:
                 await rem_delete_user(current_uuid)
                 await session.delete(rem_user)
         except Exception:
             pass
         # уведомление о паузе подписки
-        if user.telegram_id and not prev_suspended and (user.balance > 0 or prev_days is not None):
-            try:
-                await bot.send_message(
-                    int(user.telegram_id),
-                    "Подписка приостановлена — баланс закончился. Пополните баланс, чтобы возобновить.",
-                    reply_markup=webapp_keyboard(),
-                )
-            except Exception:
-                pass
+        if user.telegram_id and not prev_suspended and (user.balance > 0 or prev_days is not None) and not dry_run:
+            await enqueue_notification(session, user, SUBSCRIPTION_PAUSED_TEXT, f"paused:{user.id}:{now_utc().date()}")
     else:
         expires_at = now_utc() + timedelta(days=estimated_days)
-        user.subscription_end = expires_at
+        set_paid_until(user, expires_at)
         user.allowed_devices = device_count
         user.link_suspended = False
-        try:
-            panel_uuid, short_uuid, sub_url = await rem_upsert_user(session, user, device_count, expires_at)
-            rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
-            current_uuid = panel_uuid or (rem_user.panel_uuid if rem_user else "") or panel_uuid_current
-            if not current_uuid:
-                current_uuid = short_uuid or (rem_user.short_uuid if rem_user else "") or short_uuid_current
-            await rem_enable_user(current_uuid)
-            if sub_url:
-                link_value = sub_url
-            elif rem_user and rem_user.subscription_url:
-                link_value = rem_user.subscription_url
-        except Exception:
-            user.link_suspended = True
-            link_value = ""
+        if not dry_run:
+            try:
+                panel_uuid, short_uuid, sub_url = await rem_upsert_user(session, user, device_count, expires_at)
+                rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
+                current_uuid = panel_uuid or (rem_user.panel_uuid if rem_user else "") or panel_uuid_current
+                if not current_uuid:
+                    current_uuid = short_uuid or (rem_user.short_uuid if rem_user else "") or short_uuid_current
+                await rem_enable_user(current_uuid)
+                if sub_url:
+                    link_value = sub_url
+                elif rem_user and rem_user.subscription_url:
+                    link_value = rem_user.subscription_url
+            except Exception:
+                user.link_suspended = True
+                link_value = ""
         # если после вызова ссылка не появилась — пробуем взять из rem_user
         if not link_value:
             rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
             if rem_user and rem_user.subscription_url:
                 link_value = rem_user.subscription_url
-        # уведомление о скором окончании
-        if user.telegram_id and 0 < estimated_days <= 3 and user.balance > 0 and prev_days is not None:
-            send_warn = True
-            if prev_days is not None and prev_days <= 3:
-                send_warn = False
-            if send_warn:
-                try:
-                    await bot.send_message(
-                        int(user.telegram_id),
-                        "У вас осталось менее 3 дней подписки. Пополните баланс, чтобы продолжить.",
-                        reply_markup=webapp_keyboard(),
-                    )
-                except Exception:
-                    pass
+        # предупреждение «осталось менее 3 дней» отправляет sweep_expiry_once
 
     await session.commit()
     return {
@@ -345,133 +580,315 @@ async def rem_delete_hwid(session: AsyncSession, user: models.User, hwid: str) -
                 return
 
 
-async def rem_upsert_user(
-    session: AsyncSession, user: models.User, devices: int, expires_at: datetime
-) -> tuple[str, Optional[str], Optional[str]]:
-    base_url, base_api, token = get_rem_config()
-    rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
-    squad = None
-    if rem_user:
-        squad = await session.get(models.RemSquad, rem_user.squad_id)
-    if not squad:
-        squad = await pick_rem_squad(session)
-    if not squad:
-        raise HTTPException(status_code=503, detail="Нет свободных Remnawave сквадов")
-
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    expire_str = expires_at.astimezone(__import__("datetime").timezone.utc).isoformat(timespec="milliseconds")
+def rem_expire_str(expires_at: datetime) -> str:
+    expire_str = expires_at.astimezone(timezone.utc).isoformat(timespec="milliseconds")
     if expire_str.endswith("+00:00"):
         expire_str = expire_str[:-6] + "Z"
-    payload = {
+    return expire_str
+
+
+def rem_user_payload(user: models.User, devices: int, expires_at: datetime, squad: models.RemSquad) -> dict:
+    return {
         "username": f"tg{user.telegram_id}",
-        "expireAt": expire_str,
+        "expireAt": rem_expire_str(expires_at),
         "hwidDeviceLimit": devices,
         "activeInternalSquads": [squad.uuid],
         "telegramId": int(user.telegram_id) if str(user.telegram_id).isdigit() else None,
         "description": f"TG {user.telegram_id}",
     }
 
-    async with aiohttp.ClientSession() as http:
-        data = None
-        attempted_patch = False
-        if rem_user and rem_user.panel_uuid:
-            payload["uuid"] = rem_user.panel_uuid
-            attempted_patch = True
-            async with http.patch(f"{base_api}/users", json=payload, headers=headers) as resp:
-                if resp.status in (200, 201, 204):
-                    data = await resp.json()
-                else:
-                    # Если пользователя в панели уже удалили (404) — пробуем создать заново
-                    if resp.status != 404:
-                        detail = await resp.text()
-                        raise HTTPException(status_code=503, detail=f"Remnawave update failed: {detail}")
-        if data is None:
-            async with http.post(f"{base_api}/users", json=payload, headers=headers) as resp:
-                if resp.status not in (200, 201, 204):
-                    detail = await resp.text()
-                    raise HTTPException(status_code=503, detail=f"Remnawave create failed: {detail}")
-                data = await resp.json()
 
-        response_data = data.get("response") if isinstance(data, dict) else {}
-        user_payload = response_data
-        if isinstance(response_data, dict) and "users" in response_data:
-            users_list = response_data.get("users") or []
-            if users_list:
-                user_payload = users_list[0]
-
-        panel_uuid = None
-        short_uuid = None
-        sub_url = None
-
-        if isinstance(user_payload, dict):
-            panel_uuid = user_payload.get("uuid") or user_payload.get("id")
-            short_uuid = user_payload.get("shortUuid") or user_payload.get("subscriptionUuid")
-            sub_url = user_payload.get("subscriptionUrl")
-        if panel_uuid is None and rem_user:
-            panel_uuid = rem_user.panel_uuid
-
-        if rem_user:
-            rem_user.panel_uuid = panel_uuid or rem_user.panel_uuid
-            rem_user.short_uuid = short_uuid or rem_user.short_uuid
-            rem_user.subscription_url = sub_url or rem_user.subscription_url
-            rem_user.squad_id = squad.id
-        else:
-            rem_user = models.RemUser(
+async def rem_push_user(
+    http: aiohttp.ClientSession, payload: dict, panel_uuid: Optional[str]
+) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    """Только HTTP: обновляет (или создаёт) пользователя в Remnawave, БД не трогает."""
+    base_url, base_api, token = get_rem_config()
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    data = None
+    if panel_uuid:
+        payload = {**payload, "uuid": panel_uuid}
+        async with http.patch(f"{base_api}/users", json=payload, headers=headers) as resp:
+            if resp.status in (200, 201, 204):
+                data = await resp.json()
+            else:
+                # Если пользователя в панели уже удалили (404) — пробуем создать заново
+                if resp.status != 404:
+                    detail = await resp.text()
+                    raise HTTPException(status_code=503, detail=f"Remnawave update failed: {detail}")
+    if data is None:
+        async with http.post(f"{base_api}/users", json=payload, headers=headers) as resp:
+            if resp.status not in (200, 201, 204):
+                detail = await resp.text()
+                raise HTTPException(status_code=503, detail=f"Remnawave create failed: {detail}")
+            data = await resp.json()
+
+    response_data = data.get("response") if isinstance(data, dict) else {}
+    user_payload = response_data
+    if isinstance(response_data, dict) and "users" in response_data:
+        users_list = response_data.get("users") or []
+        if users_list:
+            user_payload = users_list[0]
+
+    new_uuid = None
+    short_uuid = None
+    sub_url = None
+    if isinstance(user_payload, dict):
+        new_uuid = user_payload.get("uuid") or user_payload.get("id")
+        short_uuid = user_payload.get("shortUuid") or user_payload.get("subscriptionUuid")
+        sub_url = user_payload.get("subscriptionUrl")
+    return new_uuid, short_uuid, sub_url
+
+
+def rem_apply_result(
+    session: AsyncSession,
+    user: models.User,
+    rem_user: Optional[models.RemUser],
+    squad: models.RemSquad,
+    result: tuple[Optional[str], Optional[str], Optional[str]],
+) -> tuple[str, Optional[str], Optional[str]]:
+    panel_uuid, short_uuid, sub_url = result
+    if panel_uuid is None and rem_user:
+        panel_uuid = rem_user.panel_uuid
+    if rem_user:
+        rem_user.panel_uuid = panel_uuid or rem_user.panel_uuid
+        rem_user.short_uuid = short_uuid or rem_user.short_uuid
+        rem_user.subscription_url = sub_url or rem_user.subscription_url
+        rem_user.squad_id = squad.id
+    else:
+        session.add(
+            models.RemUser(
                 user_id=user.id,
                 squad_id=squad.id,
                 panel_uuid=panel_uuid or "",
                 short_uuid=short_uuid,
                 subscription_url=sub_url,
             )
-            session.add(rem_user)
+        )
+    return panel_uuid or "", short_uuid, sub_url
 
-        return panel_uuid or "", short_uuid, sub_url
 
+async def rem_bulk_update(http: aiohttp.ClientSession, uuids: list[str], fields: dict) -> int:
+    """POST /api/users/bulk/update: одинаковые поля для пачки (до 500) пользователей панели."""
+    base_url, base_api, token = get_rem_config()
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    async with http.post(f"{base_api}/users/bulk/update", json={"uuids": uuids, "fields": fields}, headers=headers) as resp:
+        if resp.status not in (200, 201):
+            detail = await resp.text()
+            raise HTTPException(status_code=503, detail=f"Remnawave bulk update failed: {detail}")
+        data = await resp.json()
+    response = data.get("response") if isinstance(data, dict) else None
+    return int((response or {}).get("affectedRows") or 0)
+
+
+async def rem_upsert_user(
+    session: AsyncSession, user: models.User, devices: int, expires_at: datetime
+) -> tuple[str, Optional[str], Optional[str]]:
+    get_rem_config()
+    rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
+    squad = None
+    if rem_user:
+        squad = await session.get(models.RemSquad, rem_user.squad_id)
+    if not squad:
+        squad = await pick_rem_squad(session)
+    if not squad:
+        raise HTTPException(status_code=503, detail="Нет свободных Remnawave сквадов")
+
+    payload = rem_user_payload(user, devices, expires_at, squad)
+    async with aiohttp.ClientSession() as http:
+        result = await rem_push_user(http, payload, rem_user.panel_uuid if rem_user else None)
+    return rem_apply_result(session, user, rem_user, squad, result)
 
-async def bill_users_once() -> None:
+
+async def bill_users_once(concurrency: Optional[int] = None, dry_run: bool = False) -> Optional[dict]:
+    """
+    Ежедневное списание. Пользователи обрабатываются пачками по id: сначала для пачки
+    параллельно (не больше concurrency запросов) выполняются вызовы панели, затем изменения
+    в БД применяются только для тех, у кого вызов прошёл. Позиция сохраняется после каждой
+    пачки, поэтому перезапуск в тот же день продолжает с места остановки.
+    dry_run — панель не вызывается, вызовы считаются успешными (симулятор, копия БД).
+    """
+    concurrency = max(1, concurrency or settings.billing_concurrency)
     async with AsyncSessionLocal() as session:
         today = now_utc().date().isoformat()
         last = await session.get(models.AppSetting, "last_billed_date")
         if last and last.value == today:
-            return
+            return None
+
+        cursor_setting = await session.get(models.AppSetting, "billing_cursor")
+        last_id = 0
+        if cursor_setting and cursor_setting.value.startswith(f"{today}:"):
+            last_id = int(cursor_setting.value.split(":", 1)[1] or 0)
+        elif not cursor_setting:
+            cursor_setting = models.AppSetting(key="billing_cursor", value=f"{today}:0")
+            session.add(cursor_setting)
+            # коммит до вызовов панели: незакоммиченная запись держала бы блокировку SQLite всю первую пачку
+            await session.commit()
+
+        started = time.monotonic()
+        results: dict[int, str] = {}
+        errors: list[dict] = []
+        revenue = 0
+        semaphore = asyncio.Semaphore(concurrency)
 
         price_value = await get_price(session)
-        users = (await session.scalars(select(models.User))).all()
-        for user in users:
-            device_count = await session.scalar(
-                select(func.count(models.Device.id)).where(models.Device.user_id == user.id)
-            ) or 1
-            cost = price_value * max(device_count, 1)
-            if cost <= 0:
-                continue
-            if user.balance >= cost:
-                user.balance -= cost
-                days_left = int(user.balance / cost) + 1
-                expires_at = now_utc() + timedelta(days=days_left)
-                user.subscription_end = expires_at
-                user.allowed_devices = device_count
-                user.link_suspended = False
-                try:
-                    await rem_upsert_user(session, user, device_count, expires_at)
-                except Exception:
-                    user.link_suspended = True
-            else:
-                user.link_suspended = True
-                user.subscription_end = None
+        squads = {s.id: s for s in (await session.scalars(select(models.RemSquad).order_by(models.RemSquad.id))).all()}
+        squad_load = {squad_id: squad.users_count for squad_id, squad in squads.items()}
+
+        def pick_squad() -> Optional[models.RemSquad]:
+            # место резервируется до вызова панели (параллельные вызовы пачки не переполнят сквад)
+            # и освобождается, если вызов не прошёл
+            for squad in squads.values():
+                if squad_load.get(squad.id, 0) < squad.capacity:
+                    squad_load[squad.id] = squad_load.get(squad.id, 0) + 1
+                    return squad
+            return None
+
+        async def panel_call(http: aiohttp.ClientSession, plan: dict) -> None:
+            async with semaphore:
                 try:
-                    rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == user.id))
-                    if rem_user and rem_user.panel_uuid:
-                        await rem_delete_user(rem_user.panel_uuid)
-                        await session.delete(rem_user)
-                except Exception:
-                    pass
-
+                    if dry_run:
+                        rem_user = plan["rem_user"]
+                        if plan["action"] == "charge":
+                            if not plan["squad"]:
+                                raise HTTPException(status_code=503, detail="Нет свободных Remnawave сквадов")
+                            dry_uuid = rem_user.panel_uuid if rem_user else f"dry-run-{plan['user'].id}"
+                            plan["result"] = (dry_uuid, None, None)
+                        plan["ok"] = True
+                        return
+                    if plan["action"] == "charge":
+                        if not plan["squad"]:
+                            raise HTTPException(status_code=503, detail="Нет свободных Remnawave сквадов")
+                        rem_user = plan["rem_user"]
+                        plan["result"] = await rem_push_user(
+                            http, plan["payload"], rem_user.panel_uuid if rem_user else None
+                        )
+                    elif plan["rem_user"] and plan["rem_user"].panel_uuid:
+                        await rem_delete_user(plan["rem_user"].panel_uuid, http)
+                    plan["ok"] = True
+                except Exception as exc:  # noqa: BLE001
+                    plan["ok"] = False
+                    plan["error"] = getattr(exc, "detail", None) or str(exc) or exc.__class__.__name__
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            while True:
+                users = (
+                    await session.scalars(
+                        select(models.User)
+                        .where(models.User.id > last_id)
+                        .order_by(models.User.id)
+                        .limit(settings.billing_batch_size)
+                    )
+                ).all()
+                if not users:
+                    break
+                ids = [u.id for u in users]
+                rem_users = {
+                    r.user_id: r
+                    for r in (await session.scalars(select(models.RemUser).where(models.RemUser.user_id.in_(ids)))).all()
+                }
+
+                plans: list[dict] = []
+                for user in users:
+                    device_count = max(user.devices_count, 1)
+                    charge = daily_charge(price_value, device_count)
+                    if charge <= 0:
+                        results[user.id] = "skipped"
+                        continue
+                    rem_user = rem_users.get(user.id)
+                    if user.balance >= charge:
+                        days_left = user.balance // charge
+                        expires_at = now_utc() + timedelta(days=days_left)
+                        squad = squads.get(rem_user.squad_id) if rem_user else None
+                        reserved = None
+                        if not squad:
+                            squad = reserved = pick_squad()
+                        plans.append(
+                            {
+                                "action": "charge",
+                                "user": user,
+                                "charge": charge,
+                                "device_count": device_count,
+                                "expires_at": expires_at,
+                                "rem_user": rem_user,
+                                "squad": squad,
+                                "reserved": reserved,
+                                "payload": rem_user_payload(user, device_count, expires_at, squad) if squad else None,
+                            }
+                        )
+                    else:
+                        plans.append({"action": "suspend", "user": user, "rem_user": rem_user})
+
+                await asyncio.gather(*(panel_call(http, plan) for plan in plans))
+
+                # без autoflush записи журнала копятся и уходят одним пакетным INSERT при commit пачки
+                with session.no_autoflush:
+                    for plan in plans:
+                        user = plan["user"]
+                        if plan["action"] == "charge":
+                            if not plan["ok"]:
+                                if plan["reserved"]:
+                                    squad_load[plan["reserved"].id] -= 1
+                                results[user.id] = "error"
+                                errors.append({"user_id": user.id, "error": plan["error"]})
+                                continue
+                            # списание в SQL: зачисление, прошедшее во время вызовов панели, не затирается
+                            charged = await apply_balance(
+                                session, user.id, -plan["charge"], models.LEDGER_CHARGE, comment=f"billing {today}"
+                            )
+                            if charged is None:
+                                # баланс успел уменьшиться: пользователя панели запоминаем, срок исправит recalc_subscription
+                                rem_apply_result(session, user, plan["rem_user"], plan["squad"], plan["result"])
+                                results[user.id] = "error"
+                                errors.append({"user_id": user.id, "error": "insufficient balance at debit"})
+                                continue
+                            revenue += plan["charge"]
+                            set_paid_until(user, plan["expires_at"])
+                            user.allowed_devices = plan["device_count"]
+                            user.link_suspended = False
+                            rem_apply_result(session, user, plan["rem_user"], plan["squad"], plan["result"])
+                            results[user.id] = "charged"
+                        else:
+                            user.link_suspended = True
+                            user.subscription_end = None
+                            user.expiry_warned_at = None
+                            if plan["rem_user"] and plan["rem_user"].panel_uuid:
+                                if plan["ok"]:
+                                    await session.delete(plan["rem_user"])
+                                else:
+                                    errors.append({"user_id": user.id, "error": plan["error"]})
+                            results[user.id] = "suspended"
+                last_id = ids[-1]
+                cursor_setting.value = f"{today}:{last_id}"
+                await session.commit()
+
+        duration = time.monotonic() - started
+        outcomes = list(results.values())
+        report = {
+            "date": today,
+            "users": len(outcomes),
+            "charged": outcomes.count("charged"),
+            "suspended": outcomes.count("suspended"),
+            "skipped": outcomes.count("skipped"),
+            "errors": len(errors),
+            "revenue": revenue,
+            "dry_run": dry_run,
+            "concurrency": concurrency,
+            "duration_sec": round(duration, 3),
+            "users_per_sec": round(len(outcomes) / duration, 1) if duration > 0 else None,
+            "error_samples": errors[:20],
+        }
+        # отчёт хранится в БД: его видит любой воркер, а не только лидер, который списывал
+        session.add(models.BillingRun(date=today, report=json.dumps(report, default=str), created_at=now_utc()))
         if last:
             last.value = today
         else:
             session.add(models.AppSetting(key="last_billed_date", value=today))
         await session.commit()
 
+    logger.info("billing report %s", {k: v for k, v in report.items() if k != "error_samples"})
+    return report
+
 
 async def billing_loop():
     while True:
@@ -482,6 +899,1067 @@ async def billing_loop():
         await asyncio.sleep(24 * 3600)
 
 
+async def sweep_expiry_once() -> dict:
+    """
+    Обходит только «созревших» пользователей диапазонными запросами по индексам
+    trial_expires_at и subscription_end: закрывает истёкшие пробные периоды, пачками
+    приостанавливает подписки с истёкшим сроком и один раз предупреждает тех,
+    у кого осталось меньше expiry_warn_days дней.
+    """
+    batch = settings.expiry_sweep_batch
+    stats = {"trials": 0, "suspended": 0, "warned": 0}
+    now = now_utc()
+    async with AsyncSessionLocal() as session:
+        # 1. истёкшие пробные периоды: баланс обнуляется, срок подписки становится «сейчас»
+        while True:
+            users = (
+                await session.scalars(
+                    select(models.User)
+                    .where(models.User.trial_expires_at.is_not(None), models.User.trial_expires_at <= now)
+                    .order_by(models.User.trial_expires_at)
+                    .limit(batch)
+                )
+            ).all()
+            if not users:
+                break
+            for user in users:
+                if await expire_trial(session, user):
+                    stats["trials"] += 1
+                    if not user.link_suspended:
+                        user.subscription_end = now
+                else:
+                    user.trial_expires_at = None
+            await session.commit()
+
+        # 2. срок подписки истёк, а доступ ещё открыт
+        price_value = await get_price(session)
+        semaphore = asyncio.Semaphore(max(1, settings.billing_concurrency))
+        last_end, last_id = None, 0
+        async with aiohttp.ClientSession() as http:
+            while True:
+                query = select(models.User).where(
+                    models.User.link_suspended.is_(False),
+                    models.User.subscription_end.is_not(None),
+                    models.User.subscription_end <= now,
+                )
+                if last_end is not None:
+                    query = query.where(
+                        or_(
+                            models.User.subscription_end > last_end,
+                            and_(models.User.subscription_end == last_end, models.User.id > last_id),
+                        )
+                    )
+                users = (
+                    await session.scalars(query.order_by(models.User.subscription_end, models.User.id).limit(batch))
+                ).all()
+                if not users:
+                    break
+                last_end, last_id = users[-1].subscription_end, users[-1].id
+                ids = [u.id for u in users]
+                # у кого баланса хватает хотя бы на день, срок продлит биллинг
+                due = [
+                    u
+                    for u in users
+                    if u.banned or not price_value or u.balance < daily_charge(price_value, u.devices_count)
+                ]
+                if not due:
+                    continue
+                rem_users = {
+                    r.user_id: r
+                    for r in (
+                        await session.scalars(select(models.RemUser).where(models.RemUser.user_id.in_([u.id for u in due])))
+                    ).all()
+                }
+
+                async def drop(rem_user: models.RemUser) -> bool:
+                    async with semaphore:
+                        try:
+                            await rem_delete_user(rem_user.panel_uuid, http)
+                            return True
+                        except Exception:
+                            return False
+
+                with_panel = [r for r in rem_users.values() if r.panel_uuid]
+                dropped = await asyncio.gather(*(drop(r) for r in with_panel))
+                for rem_user, ok in zip(with_panel, dropped):
+                    if ok:
+                        await session.delete(rem_user)
+                for user in due:
+                    user.link_suspended = True
+                    user.subscription_end = None
+                    user.expiry_warned_at = None
+                    await enqueue_notification(session, user, SUBSCRIPTION_PAUSED_TEXT, f"paused:{user.id}:{now.date()}")
+                await session.commit()
+                stats["suspended"] += len(due)
+
+        # 3. осталось меньше expiry_warn_days дней — предупреждаем ровно один раз;
+        # начавшие период уже с коротким сроком помечены в set_paid_until и сюда не попадают
+        warn_until = now + timedelta(days=settings.expiry_warn_days)
+        while True:
+            users = (
+                await session.scalars(
+                    select(models.User)
+                    .where(
+                        models.User.subscription_end > now,
+                        models.User.subscription_end <= warn_until,
+                        models.User.expiry_warned_at.is_(None),
+                        models.User.link_suspended.is_(False),
+                        models.User.banned.is_(False),
+                    )
+                    .order_by(models.User.subscription_end)
+                    .limit(batch)
+                )
+            ).all()
+            if not users:
+                break
+            for user in users:
+                user.expiry_warned_at = now
+                await enqueue_notification(
+                    session, user, SUBSCRIPTION_EXPIRING_TEXT, f"expiring:{user.id}:{user.subscription_end.date()}"
+                )
+            await session.commit()
+            stats["warned"] += len(users)
+    return stats
+
+
+async def dispatch_notifications_once() -> int:
+    """
+    Отправляет пачку созревших уведомлений из outbox. Заблокировавших бота помечает и пропускает,
+    временные ошибки повторяются с растущей паузой до outbox_max_attempts. Возвращает размер пачки.
+    """
+    now = now_utc()
+    async with AsyncSessionLocal() as session:
+        rows = (
+            await session.execute(
+                select(models.Notification, models.User.telegram_id, models.User.bot_blocked_at)
+                .join(models.User, models.User.id == models.Notification.user_id)
+                .where(models.Notification.status == "pending", models.Notification.next_attempt_at <= now)
+                .order_by(models.Notification.id)
+                .limit(settings.outbox_batch_size)
+            )
+        ).all()
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(settings.broadcast_concurrency)
+
+        async def deliver(note: models.Notification, telegram_id: str | None, blocked_at) -> str:
+            if not telegram_id or blocked_at:
+                return "skipped"
+            chat_id = int(telegram_id)
+            async with semaphore:
+                try:
+                    await send_limited(chat_id, lambda: bot.send_message(chat_id, note.text, reply_markup=webapp_keyboard()))
+                    return "sent"
+                except Exception as exc:  # noqa: BLE001
+                    if is_unreachable_error(exc):
+                        return "blocked"
+                    note.error = str(exc)[:512]
+                    return "retry"
+
+        results = await asyncio.gather(*(deliver(*row) for row in rows))
+        blocked_user_ids = []
+        for (note, _, _), result in zip(rows, results):
+            note.attempts += 1
+            if result == "sent":
+                note.status = "sent"
+                note.sent_at = now_utc()
+            elif result == "retry":
+                if note.attempts >= settings.outbox_max_attempts:
+                    note.status = "failed"
+                else:
+                    note.next_attempt_at = now_utc() + timedelta(seconds=30 * 2 ** note.attempts)
+            else:
+                note.status = "skipped"
+                if result == "blocked":
+                    blocked_user_ids.append(note.user_id)
+        if blocked_user_ids:
+            await session.execute(
+                update(models.User).where(models.User.id.in_(blocked_user_ids)).values(bot_blocked_at=now_utc())
+            )
+        await session.commit()
+        return len(rows)
+
+
+async def purge_notifications() -> None:
+    # ключи дедупликации нужны, пока событие может повториться; старые записи не нужны
+    cutoff = now_utc() - timedelta(days=settings.outbox_retention_days)
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            delete(models.Notification).where(
+                models.Notification.created_at < cutoff, models.Notification.status != "pending"
+            )
+        )
+        await session.commit()
+
+
+async def notification_dispatcher_loop():
+    last_purge = 0.0
+    while True:
+        try:
+            while await dispatch_notifications_once() >= settings.outbox_batch_size:
+                pass
+            if time.monotonic() - last_purge > 3600:
+                await purge_notifications()
+                last_purge = time.monotonic()
+        except Exception:
+            pass
+        await asyncio.sleep(settings.outbox_poll_interval)
+
+
+def parse_yookassa_event(data: dict) -> Optional[tuple[int, str, dict]]:
+    """(payment.id из metadata, статус, object) или None, если событие не похоже на уведомление о нашем платеже."""
+    obj = data.get("object")
+    if not isinstance(obj, dict):
+        return None
+    metadata = obj.get("metadata") or {}
+    payment_id = metadata.get("payment_id") if isinstance(metadata, dict) else None
+    status_value = obj.get("status")
+    if not str(payment_id or "").isdigit() or not status_value or not isinstance(status_value, str):
+        return None
+    return int(payment_id), status_value, obj
+
+
+async def process_yookassa_event(session: AsyncSession, data: dict) -> dict:
+
+    parsed = parse_yookassa_event(data)
+
+    if not parsed:
+
+        return {"ok": False}
+
+    payment_id, status_value, obj = parsed
+
+    payment: models.Payment | None = await session.get(models.Payment, payment_id)
+
+    if not payment or payment.status == "succeeded":
+
+        return {"ok": True}
+
+    event_id = f"{data.get('event') or status_value}:{obj.get('id') or payment.id}"
+    if not await mark_event_processed(session, "yookassa", event_id, payment.id):
+        return {"ok": True}
+
+    if status_value == "succeeded":
+
+        user = await credit_payment(session, payment, "yookassa")
+
+        if user:
+
+            await enqueue_notification(session, user, f"Баланс пополнен на {payment.amount} ₽", f"topup:{payment.id}")
+
+    else:
+
+        result = await session.execute(
+            update(models.Payment)
+            .where(models.Payment.id == payment.id, models.Payment.status != "succeeded")
+            .values(status=status_value)
+        )
+        if result.rowcount:
+            await touch_user(session, payment.user_id)
+
+    await session.commit()
+
+    return {"ok": True}
+
+
+async def process_cryptobot_event(session: AsyncSession, data: dict) -> dict:
+    """
+    Событие Crypto Bot. Ждем update_type = invoice_paid и payload с id платежа (payment.id),
+    который передаем в createInvoice.
+    """
+    if isinstance(data.get("payload"), dict):
+        # формат Crypto Pay: {"update_type": ..., "payload": <Invoice>}
+        data = {**data, "invoice": data["payload"], "payload": None}
+    update_type = data.get("update_type")
+    status_value = (data.get("status") or data.get("invoice", {}).get("status") or "").lower()
+    payload_id = (
+        data.get("payload")
+        or data.get("invoice_payload")
+        or data.get("invoice", {}).get("payload")
+        or data.get("data", {}).get("payload")
+    )
+    invoice_id = data.get("invoice_id") or data.get("invoice", {}).get("invoice_id")
+
+    if update_type != "invoice_paid" or status_value != "paid" or not payload_id:
+        logger.info("cryptobot event skipped: update_type=%s status=%s payload=%s", update_type, status_value, payload_id)
+        return {"ok": True}
+
+    try:
+        payment_pk = int(str(payload_id))
+    except ValueError:
+        payment_pk = None
+
+    payment: models.Payment | None = None
+    if payment_pk:
+        payment = await session.get(models.Payment, payment_pk)
+    if not payment and invoice_id:
+        payment = await session.scalar(
+            select(models.Payment).where(models.Payment.provider_payment_id == str(invoice_id))
+        )
+    if not payment or payment.status == "succeeded":
+        logger.warning("cryptobot event: payment not found or already credited: payment_pk=%s invoice_id=%s", payment_pk, invoice_id)
+        return {"ok": True}
+
+    event_id = str(data.get("update_id") or f"invoice_paid:{invoice_id or payment.id}")
+    if not await mark_event_processed(session, "cryptobot", event_id, payment.id):
+        return {"ok": True}
+    if invoice_id and not payment.provider_payment_id:
+        payment.provider_payment_id = str(invoice_id)
+
+    user = await credit_payment(session, payment, "cryptobot")
+    if user:
+        recalculated = await recalc_subscription(session, user)
+        await enqueue_notification(session, user, f"Баланс пополнен на {payment.amount} ₽", f"topup:{payment.id}")
+        await session.commit()
+        return {"ok": True, "link_suspended": recalculated.get("link_suspended", True)}
+
+    logger.warning("cryptobot event: payment %s was not credited (already succeeded or user missing)", payment.id)
+    await session.commit()
+    return {"ok": True}
+
+
+# обработчики сохранённых webhook'ов по провайдеру
+WEBHOOK_HANDLERS: dict[str, Callable[[AsyncSession, dict], Awaitable[dict]]] = {
+    "yookassa": process_yookassa_event,
+    "cryptobot": process_cryptobot_event,
+}
+
+# будит webhook_worker_loop, если событие принял процесс-лидер
+webhook_wakeup = asyncio.Event()
+
+
+async def store_webhook(session: AsyncSession, provider: str, data: dict) -> models.WebhookEvent:
+    event = models.WebhookEvent(provider=provider, payload=json.dumps(data, ensure_ascii=False))
+    session.add(event)
+    await session.commit()
+    webhook_wakeup.set()
+    return event
+
+
+async def process_webhook(event_id: int) -> None:
+    """Обрабатывает одно событие из webhook_inbox; при ошибке — повтор с паузой, после webhook_max_attempts — dead."""
+    async with AsyncSessionLocal() as session:
+        event = await session.get(models.WebhookEvent, event_id)
+        if event is None:
+            # строку уже удалила очистка или админ — обрабатывать нечего
+            return
+        handler = WEBHOOK_HANDLERS.get(event.provider)
+        try:
+            data = json.loads(event.payload)
+        except ValueError:
+            data = None
+        if handler is None or not isinstance(data, dict):
+            # повтор не поможет: событие закрывается как проигнорированное
+            event.status = "done"
+            event.error = "ignored: unknown provider" if handler is None else "ignored: unparsable payload"
+            event.processed_at = now_utc()
+            event.attempts += 1
+            await session.commit()
+            return
+        try:
+            async with AsyncSessionLocal() as work_session:
+                result = await handler(work_session, data)
+            event.status = "done"
+            # пустой ответ или ok=False — событие не относится ни к одному платежу
+            event.error = None if result and result.get("ok") else "ignored"
+            event.processed_at = now_utc()
+        except Exception as exc:  # noqa: BLE001
+            event.error = str(exc)[:512]
+            if event.attempts + 1 >= settings.webhook_max_attempts:
+                event.status = "dead"
+            else:
+                event.next_attempt_at = now_utc() + timedelta(seconds=10 * 2 ** event.attempts)
+        event.attempts += 1
+        await session.commit()
+
+
+async def process_webhooks_once() -> int:
+    async with AsyncSessionLocal() as session:
+        event_ids = (
+            await session.scalars(
+                select(models.WebhookEvent.id)
+                .where(models.WebhookEvent.status == "pending", models.WebhookEvent.next_attempt_at <= now_utc())
+                .order_by(models.WebhookEvent.id)
+                .limit(settings.webhook_batch_size)
+            )
+        ).all()
+    # события разных платежей независимы; одно и то же событие защищено processed_events
+    semaphore = asyncio.Semaphore(settings.webhook_concurrency)
+
+    async def run(event_id: int) -> None:
+        async with semaphore:
+            await process_webhook(event_id)
+
+    await asyncio.gather(*(run(event_id) for event_id in event_ids))
+    return len(event_ids)
+
+
+async def webhook_worker_loop():
+    last_purge = 0.0
+    while True:
+        try:
+            while await process_webhooks_once() >= settings.webhook_batch_size:
+                pass
+            if time.monotonic() - last_purge > 3600:
+                cutoff = now_utc() - timedelta(days=settings.webhook_retention_days)
+                async with AsyncSessionLocal() as session:
+                    await session.execute(
+                        delete(models.WebhookEvent).where(
+                            models.WebhookEvent.status == "done", models.WebhookEvent.created_at < cutoff
+                        )
+                    )
+                    await session.commit()
+                last_purge = time.monotonic()
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(webhook_wakeup.wait(), timeout=settings.webhook_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        webhook_wakeup.clear()
+
+
+# провайдеры, платежи которых создаются через YooKassa
+YOOKASSA_PROVIDERS = ("sbp", "card")
+
+
+async def reconcile_payments_once() -> dict:
+    """
+    Платежи, зависшие в pending дольше payment_reconcile_after_minutes (например, потерян webhook).
+    Статус запрашивается у YooKassa или Crypto Pay (не больше payment_reconcile_concurrency запросов
+    одновременно) и применяется тем же идемпотентным кодом, что и webhook. Неоплаченные дольше
+    payment_expire_after_hours помечаются expired.
+    """
+    now = now_utc()
+    stale_before = now - timedelta(minutes=settings.payment_reconcile_after_minutes)
+    expire_before = now - timedelta(hours=settings.payment_expire_after_hours)
+    stats = {"checked": 0, "succeeded": 0, "canceled": 0, "expired": 0, "errors": 0}
+    semaphore = asyncio.Semaphore(settings.payment_reconcile_concurrency)
+
+    async def check(payment_id: int, provider: str, provider_payment_id: str | None, created_at: datetime) -> str:
+        remote_status = None
+        if provider in YOOKASSA_PROVIDERS and provider_payment_id:
+            async with semaphore:
+                try:
+                    remote_status = (await yookassa_fetch_payment(provider_payment_id)).status
+                except Exception:  # noqa: BLE001
+                    return "errors"
+        elif provider == "crypto" and provider_payment_id and cryptopay.enabled:
+            async with semaphore:
+                try:
+                    invoice = await cryptopay.get_invoice(provider_payment_id)
+                except Exception:  # noqa: BLE001
+                    return "errors"
+            if invoice and invoice.get("status") == "paid":
+                async with AsyncSessionLocal() as session:
+                    await process_cryptobot_event(session, {"update_type": "invoice_paid", "payload": invoice})
+                return "succeeded"
+        async with AsyncSessionLocal() as session:
+            if remote_status in ("succeeded", "canceled"):
+                event = {
+                    "event": f"payment.{remote_status}",
+                    "object": {"id": provider_payment_id, "status": remote_status, "metadata": {"payment_id": payment_id}},
+                }
+                await process_yookassa_event(session, event)
+                return remote_status
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            if created_at < expire_before:
+                user_id = await session.scalar(
+                    update(models.Payment)
+                    .where(models.Payment.id == payment_id, models.Payment.status == "pending")
+                    .values(status="expired")
+                    .returning(models.Payment.user_id)
+                )
+                if user_id is not None:
+                    await touch_user(session, user_id)
+                await session.commit()
+                return "expired" if user_id is not None else "checked"
+        return "checked"
+
+    last_created, last_id = None, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            query = select(
+                models.Payment.id, models.Payment.provider, models.Payment.provider_payment_id, models.Payment.created_at
+            ).where(models.Payment.status == "pending", models.Payment.created_at < stale_before)
+            if last_created is not None:
+                query = query.where(
+                    or_(
+                        models.Payment.created_at > last_created,
+                        and_(models.Payment.created_at == last_created, models.Payment.id > last_id),
+                    )
+                )
+            rows = (
+                await session.execute(
+                    query.order_by(models.Payment.created_at, models.Payment.id).limit(settings.payment_reconcile_batch)
+                )
+            ).all()
+        if not rows:
+            break
+        results = await asyncio.gather(*(check(*row) for row in rows))
+        stats["checked"] += len(rows)
+        for result in results:
+            if result != "checked":
+                stats[result] += 1
+        last_id, last_created = rows[-1][0], rows[-1][3]
+    return stats
+
+
+async def payment_reconciler_loop():
+    while True:
+        try:
+            stats = await reconcile_payments_once()
+            for key, value in stats.items():
+                if value:
+                    metrics.inc("payment_reconcile_total", value, result=key)
+        except Exception:
+            pass
+        await asyncio.sleep(settings.payment_reconcile_interval)
+
+
+async def check_counters_once() -> dict[str, int]:
+    """Сверяет денормализованные счётчики с COUNT и чинит разошедшиеся строки."""
+    fixed = {}
+    async with AsyncSessionLocal() as session:
+        for counter, fk in models.COUNTERS:
+            result = await session.execute(models.counter_repair(counter, fk))
+            fixed[f"{counter.class_.__tablename__}.{counter.key}"] = result.rowcount or 0
+        await session.commit()
+    return fixed
+
+
+async def counters_loop():
+    while True:
+        try:
+            for name, count in (await check_counters_once()).items():
+                if count:
+                    metrics.inc("counter_drift_fixed_total", count, counter=name)
+        except Exception:
+            pass
+        await asyncio.sleep(settings.counters_check_interval)
+
+
+async def expiry_sweeper_loop():
+    while True:
+        try:
+            await sweep_expiry_once()
+        except Exception:
+            pass
+        await asyncio.sleep(settings.expiry_sweep_interval)
+
+
+async def purge_idempotency_keys() -> int:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.expires_at < now_utc()))
+        await session.commit()
+    return result.rowcount or 0
+
+
+async def idempotency_purge_loop():
+    while True:
+        try:
+            await purge_idempotency_keys()
+        except Exception:
+            pass
+        await asyncio.sleep(settings.idempotency_purge_interval)
+
+
+def job_active_seconds(job: models.Job, until: datetime) -> float:
+    elapsed = job.active_seconds or 0.0
+    if job.resumed_at:
+        resumed_at = job.resumed_at if job.resumed_at.tzinfo else job.resumed_at.replace(tzinfo=timezone.utc)
+        until = until if until.tzinfo else until.replace(tzinfo=timezone.utc)
+        elapsed += max((until - resumed_at).total_seconds(), 0.0)
+    return elapsed
+
+
+def job_to_dict(job: models.Job) -> dict:
+    # скорость и ETA считаются по счётчикам задачи, без обращений к Telegram
+    # время на паузе и в очереди после resume не учитывается
+    rate = eta = None
+    if job.processed:
+        elapsed = job_active_seconds(job, job.finished_at or now_utc())
+        if elapsed > 0:
+            rate = round(job.processed / elapsed, 2)
+            if job.status in ("pending", "running"):
+                eta = int(max(job.total - job.processed, 0) / rate) if rate else None
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "params": json.loads(job.params or "{}"),
+        "total": job.total,
+        "processed": job.processed,
+        "succeeded": job.succeeded,
+        "failed": job.failed,
+        "skipped": job.skipped,
+        "blocked": job.blocked,
+        "rate": rate,
+        "eta_seconds": eta,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+async def job_should_stop(session: AsyncSession, job: models.Job) -> bool:
+    # статус мог поменять админ из другого процесса
+    await session.refresh(job, ["status"])
+    return job.status not in ("pending", "running")
+
+
+async def run_recompute_job(job_id: int) -> None:
+    """
+    Пересчёт «оплачено до» для всех незабаненных пользователей после смены цены.
+    В панель уходят только изменившиеся сроки: пользователи группируются по числу
+    оставшихся дней, и каждая группа обновляется через /api/users/bulk/update.
+    У кого нет пользователя в панели, срок обновляется только в БД.
+    Тем, кому при новой цене не хватает на день, срок ставится «сейчас» —
+    их приостановит sweep_expiry_once. Приостановленные, кому при новой цене хватает
+    хотя бы на день, возобновляются через recalc_subscription.
+    """
+    async with AsyncSessionLocal() as session:
+        job = await session.get(models.Job, job_id)
+        price_value = await get_price(session)
+        async with aiohttp.ClientSession() as http:
+            while not await job_should_stop(session, job):
+                users = (
+                    await session.scalars(
+                        select(models.User)
+                        .where(models.User.id > job.cursor, models.User.banned.is_(False))
+                        .order_by(models.User.id)
+                        .limit(settings.recompute_batch_size)
+                    )
+                ).all()
+                if not users:
+                    job.status = "done"
+                    job.finished_at = now_utc()
+                    await session.commit()
+                    return
+                now = now_utc()
+                ids = [u.id for u in users]
+                panel_uuids = dict(
+                    (
+                        await session.execute(
+                            select(models.RemUser.user_id, models.RemUser.panel_uuid).where(models.RemUser.user_id.in_(ids))
+                        )
+                    ).all()
+                )
+                groups: dict[int, list[models.User]] = {}
+                resume: list[models.User] = []
+                for user in users:
+                    cost = daily_charge(price_value, user.devices_count)
+                    days = user.balance // cost if cost > 0 else 0
+                    if user.link_suspended:
+                        if days > 0:
+                            resume.append(user)
+                        else:
+                            job.skipped += 1
+                        continue
+                    prev_days = None
+                    if user.subscription_end:
+                        sub_end = user.subscription_end
+                        if sub_end.tzinfo is None:
+                            sub_end = sub_end.replace(tzinfo=timezone.utc)
+                        prev_days = math.ceil((sub_end - now).total_seconds() / 86400)
+                    if days <= 0:
+                        user.subscription_end = now
+                        job.succeeded += 1
+                    elif prev_days == days:
+                        job.skipped += 1
+                    elif not panel_uuids.get(user.id):
+                        # в панели пользователя нет — срок меняется только в БД
+                        set_paid_until(user, now + timedelta(days=days))
+                        job.succeeded += 1
+                    else:
+                        groups.setdefault(days, []).append(user)
+                for days, group in groups.items():
+                    expires_at = now + timedelta(days=days)
+                    for start in range(0, len(group), 500):
+                        chunk = group[start : start + 500]
+                        try:
+                            await rem_bulk_update(
+                                http, [panel_uuids[u.id] for u in chunk], {"expireAt": rem_expire_str(expires_at)}
+                            )
+                        except Exception as exc:  # noqa: BLE001
+                            job.failed += len(chunk)
+                            job.error = str(getattr(exc, "detail", None) or exc)[:512]
+                            continue
+                        for user in chunk:
+                            set_paid_until(user, expires_at)
+                        job.succeeded += len(chunk)
+                job.processed += len(users)
+                job.cursor = ids[-1]
+                # возобновление требует создать пользователя в панели — по одному, как при заходе в приложение
+                for user in resume:
+                    try:
+                        resumed = not (await recalc_subscription(session, user))["link_suspended"]
+                    except Exception as exc:  # noqa: BLE001
+                        resumed = False
+                        job.error = str(getattr(exc, "detail", None) or exc)[:512]
+                    if resumed:
+                        job.succeeded += 1
+                    else:
+                        job.failed += 1
+                await session.commit()
+
+
+async def broadcast_send(chat_id: int, params: dict) -> types.Message:
+    text = params.get("text") or ""
+    # file_id из первой отправки: Telegram не скачивает и не принимает файл заново
+    photo = params.get("photo_file_id") or params.get("photo_url")
+    # photo_path — фото в upload_dir, если ADMIN_TG_ID не задан
+    if not photo and params.get("photo_path"):
+        photo = types.FSInputFile(params["photo_path"])
+    if photo:
+        return await send_limited(
+            chat_id, lambda: bot.send_photo(chat_id, photo, caption=text or None, reply_markup=webapp_keyboard())
+        )
+    return await send_limited(chat_id, lambda: bot.send_message(chat_id, text, reply_markup=webapp_keyboard()))
+
+
+def broadcast_needs_file_id(params: dict) -> bool:
+    return bool(params.get("photo_path") or params.get("photo_url")) and not params.get("photo_file_id")
+
+
+async def save_upload(file: UploadFile, prefix: str, max_bytes: int) -> str:
+    """Копирует загрузку на диск кусками, не держа файл целиком в памяти; больше max_bytes — 413."""
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    ext = os.path.splitext(file.filename or "")[1] or ".jpg"
+    path = os.path.join(settings.upload_dir, f"{prefix}-{uuid.uuid4().hex}{ext}")
+    size = 0
+    try:
+        with open(path, "wb") as fh:
+            while chunk := await file.read(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Файл больше {max_bytes // (1024 * 1024)} МБ")
+                fh.write(chunk)
+    except BaseException:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+async def upload_broadcast_photo(file: UploadFile) -> dict:
+    """
+    Отправляет загруженное фото один раз в чат админа и возвращает параметры задачи с его file_id.
+    Задача рассылки хранит только file_id: её выполняет лидер, у которого может не быть
+    локальных файлов воркера, принявшего загрузку. Без ADMIN_TG_ID фото остаётся в upload_dir
+    (photo_path) — тогда при нескольких хостах каталог должен быть общим.
+    """
+    path = await save_upload(file, "broadcast", settings.broadcast_photo_max_bytes)
+    if not settings.admin_tg_id:
+        logger.warning("ADMIN_TG_ID is not set: broadcast photo kept in %s, upload_dir must be shared between hosts", path)
+        return {"photo_path": path}
+    try:
+        chat_id = int(settings.admin_tg_id)
+        message = await send_limited(
+            chat_id, lambda: bot.send_photo(chat_id, types.FSInputFile(path), caption="Фото для рассылки")
+        )
+    except Exception as exc:  # noqa: BLE001
+        raise HTTPException(status_code=502, detail=f"Не удалось загрузить фото в Telegram: {exc}")
+    finally:
+        remove_upload({"photo_path": path})
+    if not message.photo:
+        raise HTTPException(status_code=502, detail="Telegram не вернул file_id фото")
+    return {"photo_file_id": message.photo[-1].file_id}
+
+
+BROADCAST_SEGMENTS = ("all", "active", "suspended", "trial", "never_paid", "expiring")
+
+
+def segment_conditions(segment: str = "all", days: Optional[int] = None) -> list:
+    """
+    Условия отбора получателей рассылки (индексы ix_users_segment, ix_users_trial_claimed и ix_payments_user_status).
+    Забаненные и недоступные (bot_blocked_at) не входят ни в один сегмент.
+    """
+    now = now_utc()
+    paid = exists().where(models.Payment.user_id == models.User.id, models.Payment.status == "succeeded")
+    conditions = [models.User.banned.is_(False), models.User.bot_blocked_at.is_(None)]
+    if segment == "active":
+        conditions += [models.User.link_suspended.is_(False), models.User.subscription_end > now]
+    elif segment == "suspended":
+        conditions.append(models.User.link_suspended.is_(True))
+    elif segment == "trial":
+        conditions += [models.User.trial_claimed.is_(True), ~paid]
+    elif segment == "never_paid":
+        conditions.append(~paid)
+    elif segment == "expiring":
+        conditions += [
+            models.User.link_suspended.is_(False),
+            models.User.subscription_end > now,
+            models.User.subscription_end <= now + timedelta(days=days or settings.expiry_warn_days),
+        ]
+    return conditions
+
+
+def broadcast_segment_params(segment: str, days: Optional[int]) -> dict:
+    if segment not in BROADCAST_SEGMENTS:
+        raise HTTPException(status_code=400, detail="Неизвестный сегмент")
+    if days is not None and days < 1:
+        raise HTTPException(status_code=400, detail="days должно быть больше 0")
+    return {"segment": segment, "days": days}
+
+
+async def count_recipients(session: AsyncSession, segment: str = "all", days: Optional[int] = None) -> int:
+    return await session.scalar(select(func.count(models.User.id)).where(*segment_conditions(segment, days))) or 0
+
+
+async def iter_recipients(
+    session: AsyncSession, after_id: int = 0, batch_size: Optional[int] = None, conditions: Optional[list] = None
+) -> AsyncIterator[list[tuple[int, str]]]:
+    """
+    Получатели рассылки пачками пар (users.id, telegram_id) по ключу users.id.
+    ORM-объекты не создаются, в памяти одна пачка, первая приходит сразу.
+    conditions — условия сегмента (segment_conditions), по умолчанию все доступные.
+    """
+    batch_size = batch_size or settings.broadcast_batch_size
+    conditions = conditions if conditions is not None else segment_conditions()
+    while True:
+        rows = (
+            await session.execute(
+                select(models.User.id, models.User.telegram_id)
+                .where(models.User.id > after_id, *conditions)
+                .order_by(models.User.id)
+                .limit(batch_size)
+            )
+        ).all()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        after_id = rows[-1][0]
+
+
+async def run_broadcast_job(job_id: int) -> None:
+    """
+    Рассылка пачками по users.id. Внутри пачки сообщения уходят параллельно
+    (broadcast_concurrency), темп ограничивает send_limiter. cursor сохраняется
+    после каждой пачки, так что после перезапуска рассылка продолжается с того же места.
+    """
+    async with AsyncSessionLocal() as session:
+        job = await session.get(models.Job, job_id)
+        params = json.loads(job.params or "{}")
+        semaphore = asyncio.Semaphore(max(1, settings.broadcast_concurrency))
+        file_id_lock = asyncio.Lock()
+
+        async def deliver(telegram_id: str) -> str:
+            async with semaphore:
+                try:
+                    if broadcast_needs_file_id(params):
+                        # пока file_id не получен, фото уходит по одному получателю
+                        async with file_id_lock:
+                            if broadcast_needs_file_id(params):
+                                message = await broadcast_send(int(telegram_id), params)
+                                if message.photo:
+                                    params["photo_file_id"] = message.photo[-1].file_id
+                                    job.params = json.dumps(params, ensure_ascii=False)
+                                return "sent"
+                    await broadcast_send(int(telegram_id), params)
+                    return "sent"
+                except Exception as exc:  # noqa: BLE001
+                    return "blocked" if is_unreachable_error(exc) else "failed"
+
+        conditions = segment_conditions(params.get("segment", "all"), params.get("days"))
+        async for rows in iter_recipients(session, job.cursor, conditions=conditions):
+            if await job_should_stop(session, job):
+                if job.status == "cancelled":
+                    remove_upload(params)
+                return
+            results = await asyncio.gather(*(deliver(telegram_id) for _, telegram_id in rows))
+            blocked_ids = [user_id for (user_id, _), result in zip(rows, results) if result == "blocked"]
+            if blocked_ids:
+                await session.execute(
+                    update(models.User).where(models.User.id.in_(blocked_ids)).values(bot_blocked_at=now_utc())
+                )
+            job.succeeded += results.count("sent")
+            job.failed += results.count("failed")
+            job.blocked += len(blocked_ids)
+            job.processed += len(rows)
+            job.cursor = rows[-1][0]
+            await session.commit()
+        if await job_should_stop(session, job):
+            return
+        job.status = "done"
+        job.finished_at = now_utc()
+        await session.commit()
+        remove_upload(params)
+
+
+def remove_upload(params: dict) -> None:
+    if params.get("photo_path"):
+        try:
+            os.remove(params["photo_path"])
+        except OSError:
+            pass
+
+
+async def create_broadcast_job(session: AsyncSession, params: dict) -> models.Job:
+    total = await count_recipients(session, params.get("segment", "all"), params.get("days"))
+    job = models.Job(kind="broadcast", params=json.dumps(params, ensure_ascii=False), total=total)
+    session.add(job)
+    await session.commit()
+    job_wakeup.set()
+    return job
+
+
+# действия админа над задачей: из каких статусов -> в какой
+JOB_TRANSITIONS: dict[str, tuple[tuple[str, ...], str]] = {
+    "pause": (("pending", "running"), "paused"),
+    "resume": (("paused",), "pending"),
+    "cancel": (("pending", "running", "paused"), "cancelled"),
+}
+
+
+# будит job_runner_loop, если задача создана в процессе-лидере; иначе её подберёт опрос
+job_wakeup = asyncio.Event()
+
+# обработчики фоновых задач по Job.kind
+JOB_HANDLERS: dict[str, Callable[[int], Awaitable[None]]] = {
+    "recompute": run_recompute_job,
+    "broadcast": run_broadcast_job,
+}
+
+
+async def run_job(job_id: int, handler: Callable[[int], Awaitable[None]]) -> None:
+    async with AsyncSessionLocal() as session:
+        job = await session.get(models.Job, job_id)
+        if job.status not in ("pending", "running"):
+            return
+        job.status = "running"
+        job.started_at = job.started_at or now_utc()
+        job.resumed_at = job.resumed_at or now_utc()
+        await session.commit()
+    try:
+        await handler(job_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:  # noqa: BLE001
+        async with AsyncSessionLocal() as session:
+            job = await session.get(models.Job, job_id)
+            job.status = "failed"
+            job.error = str(exc)[:512]
+            job.finished_at = now_utc()
+            await session.commit()
+
+
+async def job_runner_loop():
+    """Берёт задачи из таблицы jobs (по одной каждого вида одновременно). Прерванные продолжаются с cursor."""
+    running: dict[int, tuple[str, asyncio.Task]] = {}
+    try:
+        while True:
+            try:
+                running = {job_id: item for job_id, item in running.items() if not item[1].done()}
+                async with AsyncSessionLocal() as session:
+                    jobs = (
+                        await session.scalars(
+                            select(models.Job)
+                            .where(models.Job.status.in_(("pending", "running")))
+                            .order_by(models.Job.id)
+                        )
+                    ).all()
+                for job in jobs:
+                    busy_kinds = {kind for kind, _ in running.values()}
+                    if job.id in running or job.kind in busy_kinds or job.kind not in JOB_HANDLERS:
+                        continue
+                    running[job.id] = (job.kind, asyncio.create_task(run_job(job.id, JOB_HANDLERS[job.kind])))
+            except Exception:
+                pass
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=settings.job_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            job_wakeup.clear()
+    finally:
+        for _, task in running.values():
+            task.cancel()
+
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+LEADER_LEASE = "singleton_tasks"
+
+
+async def acquire_lease(name: str, ttl: int) -> bool:
+    """Берёт или продлевает аренду. Условный UPDATE атомарен, поэтому держатель всегда один."""
+    now = now_utc()
+    expires_at = now + timedelta(seconds=ttl)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(models.TaskLease)
+            .where(
+                models.TaskLease.name == name,
+                or_(models.TaskLease.holder == INSTANCE_ID, models.TaskLease.expires_at < now),
+            )
+            .values(holder=INSTANCE_ID, expires_at=expires_at, updated_at=now)
+        )
+        if result.rowcount:
+            await session.commit()
+            return True
+        if await session.get(models.TaskLease, name):
+            return False
+        session.add(models.TaskLease(name=name, holder=INSTANCE_ID, expires_at=expires_at))
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return False
+        return True
+
+
+async def release_lease(name: str) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(models.TaskLease)
+            .where(models.TaskLease.name == name, models.TaskLease.holder == INSTANCE_ID)
+            .values(expires_at=now_utc())
+        )
+        await session.commit()
+
+
+async def leader_loop(tasks: list[Callable[[], Awaitable[None]]]) -> None:
+    """
+    Запускает задачи из списка только в процессе, владеющем арендой LEADER_LEASE.
+    Задачи останавливаются, если аренду не удалось продлить за leader_lease_ttl - leader_renew_interval
+    (отсчёт от начала последней успешной попытки): к моменту, когда аренда истечёт и её возьмёт
+    другой воркер, здесь они уже не работают.
+    """
+    running: dict[str, asyncio.Task] = {}
+    last_renewed = 0.0
+    stop_at = 0.0
+    while True:
+        attempt = time.monotonic()
+        # попытка продления не может съесть время, оставшееся до остановки задач
+        budget = min(settings.leader_renew_interval, stop_at - attempt) if running else settings.leader_renew_interval
+        if budget > 0:
+            try:
+                if await asyncio.wait_for(acquire_lease(LEADER_LEASE, settings.leader_lease_ttl), timeout=budget):
+                    last_renewed = attempt
+            except Exception:
+                pass
+        stop_at = last_renewed + settings.leader_lease_ttl - settings.leader_renew_interval if last_renewed else 0.0
+        is_leader = time.monotonic() < stop_at
+        metrics.leader = is_leader
+        if is_leader:
+            for factory in tasks:
+                task = running.get(factory.__name__)
+                if task is None or task.done():
+                    running[factory.__name__] = asyncio.create_task(factory())
+            await asyncio.sleep(max(0.0, min(settings.leader_renew_interval, stop_at - time.monotonic())))
+            continue
+        if running:
+            for task in running.values():
+                task.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+            running = {}
+            last_renewed = 0.0
+        await asyncio.sleep(settings.leader_renew_interval)
+
+
 app = FastAPI(title="1VPN")
 
 app.add_middleware(
@@ -496,6 +1974,8 @@ app.add_middleware(
 
     allow_headers=["*"],
 
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
+
 )
 
 
@@ -507,6 +1987,122 @@ async def internal_error_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=500, content={"detail": "error"})
 
 
+# POST-запросы, которые клиент может безопасно повторить с тем же Idempotency-Key
+IDEMPOTENT_PATHS = {
+    "/api/topup",
+    "/api/device",
+    "/api/trial",
+    "/admin/topup",
+    "/admin/ban",
+    "/admin/ui/topup",
+    "/admin/ui/debit",
+    "/admin/ui/ban",
+}
+
+
+# загрузки, размер которых проверяется по Content-Length до того, как Starlette прочитает тело
+UPLOAD_LIMITS = {"/admin/ui/broadcast_photo_upload": settings.broadcast_photo_max_bytes}
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+@app.middleware("http")
+async def upload_size_middleware(request: Request, call_next):
+    limit = UPLOAD_LIMITS.get(request.url.path)
+    if limit is None or request.method != "POST":
+        return await call_next(request)
+    length = request.headers.get("content-length")
+    if not length or not length.isdigit():
+        return JSONResponse(status_code=411, content={"detail": "Нужен заголовок Content-Length"})
+    if int(length) > limit + MULTIPART_OVERHEAD:
+        return JSONResponse(status_code=413, content={"detail": f"Файл больше {limit // (1024 * 1024)} МБ"})
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    """
+    Повтор запроса с тем же Idempotency-Key (сеть в Telegram WebView, двойное нажатие) не выполняет
+    его второй раз, а получает сохранённый ответ. Пока первый запрос выполняется — 409,
+    тот же ключ с другим телом — 422. Ответы 5xx не сохраняются, такой запрос можно повторить.
+    Запись «выполняется» живёт idempotency_processing_ttl: если воркер умер посреди запроса,
+    повтор после этого срока выполняется заново.
+    """
+    idem_key = request.headers.get("Idempotency-Key")
+    if request.method != "POST" or not idem_key or request.url.path not in IDEMPOTENT_PATHS:
+        return await call_next(request)
+    caller = request.headers.get("X-Telegram-Init") or request.headers.get("X-Admin-Token")
+    if not caller:
+        # без учётных данных ключи разных клиентов совпали бы; такой запрос всё равно получит 401
+        return await call_next(request)
+    body = await request.body()
+    key = sha256(f"{request.url.path}\n{idem_key}\n{caller}".encode()).hexdigest()
+    request_hash = sha256(body).hexdigest()
+    now = now_utc()
+    async with AsyncSessionLocal() as session:
+        record = await session.get(models.IdempotencyKey, key)
+        if record:
+            expires_at = record.expires_at if record.expires_at.tzinfo else record.expires_at.replace(tzinfo=timezone.utc)
+            if expires_at <= now:
+                await session.delete(record)
+                await session.commit()
+                record = None
+        if record:
+            if record.request_hash != request_hash:
+                return JSONResponse(status_code=422, content={"detail": "Idempotency-Key уже использован с другим запросом"})
+            if record.status != "done":
+                return JSONResponse(status_code=409, content={"detail": "Запрос уже выполняется"})
+            return Response(
+                content=record.response_body,
+                status_code=record.status_code,
+                media_type="application/json",
+                headers={"Idempotent-Replayed": "true"},
+            )
+        session.add(
+            models.IdempotencyKey(
+                key=key,
+                path=request.url.path,
+                request_hash=request_hash,
+                expires_at=now + timedelta(seconds=settings.idempotency_processing_ttl),
+            )
+        )
+        try:
+            await session.commit()
+        except IntegrityError:
+            return JSONResponse(status_code=409, content={"detail": "Запрос уже выполняется"})
+
+    try:
+        response = await call_next(request)
+        content = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await forget_idempotency_key(key)
+        raise
+    async with AsyncSessionLocal() as session:
+        record = await session.get(models.IdempotencyKey, key)
+        if record is None:
+            # запись удалена как оборванная (истёк idempotency_processing_ttl) — ответ не сохраняется
+            pass
+        elif response.status_code >= 500:
+            await session.delete(record)
+        else:
+            record.status = "done"
+            record.expires_at = now_utc() + timedelta(seconds=settings.idempotency_ttl)
+            record.status_code = response.status_code
+            record.response_body = content.decode()
+        await session.commit()
+    return Response(
+        content=content,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type,
+    )
+
+
+async def forget_idempotency_key(key: str) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.key == key))
+        await session.commit()
+
+
 
 app.mount("/static", StaticFiles(directory="app/webapp"), name="static")
 
@@ -516,7 +2112,22 @@ app.mount("/static", StaticFiles(directory="app/webapp"), name="static")
 
 async def start_bot_polling():
 
-    await dp.start_polling(bot)
+    # сессию бота не закрываем: она нужна API для отправки сообщений и после потери лидерства
+    await dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+
+
+# фоновые задачи, которые должен выполнять ровно один процесс
+SINGLETON_TASKS: list[Callable[[], Awaitable[None]]] = [
+    start_bot_polling,
+    billing_loop,
+    expiry_sweeper_loop,
+    job_runner_loop,
+    notification_dispatcher_loop,
+    webhook_worker_loop,
+    payment_reconciler_loop,
+    counters_loop,
+    idempotency_purge_loop,
+]
 
 
 
@@ -528,8 +2139,12 @@ async def startup():
 
     async with engine.begin() as conn:
 
+        await conn.run_sync(schema_lock)
+
         await conn.run_sync(Base.metadata.create_all)
 
+        await conn.run_sync(apply_migrations)
+
     # ensure admin credential exists
 
     async with AsyncSessionLocal() as session:
@@ -542,8 +2157,13 @@ async def startup():
 
             await session.commit()
 
-    asyncio.create_task(start_bot_polling())
-    asyncio.create_task(billing_loop())
+    configure_yookassa()
+
+    if cryptopay.enabled:
+
+        asyncio.create_task(crypto_rates_loop())
+
+    asyncio.create_task(leader_loop(SINGLETON_TASKS))
 
 
 
@@ -553,8 +2173,18 @@ async def startup():
 
 async def shutdown():
 
+    try:
+        await release_lease(LEADER_LEASE)
+    except Exception:
+        pass
+
     await bot.session.close()
 
+    YOOKASSA_EXECUTOR.shutdown(wait=False)
+    YOOKASSA_RECONCILE_EXECUTOR.shutdown(wait=False)
+
+    await cryptopay.close()
+
 
 
 
@@ -610,6 +2240,9 @@ async def pick_available_server(session: AsyncSession, current_user_id: Optional
 
 
 async def server_has_capacity(session: AsyncSession, server: models.Server, current_user_id: Optional[int] = None) -> bool:
+    # users_count — все назначенные на сервер; активных не больше, так что точный подсчёт нужен только у предела
+    if server.users_count < server.capacity:
+        return True
     active_count = await session.scalar(
 
         select(func.count(models.User.id)).where(
@@ -657,10 +2290,7 @@ async def pick_marzban_server(session: AsyncSession) -> Optional[models.MarzbanS
     if not servers:
         return None
     for server in servers:
-        used = await session.scalar(
-            select(func.count(models.MarzbanUser.id)).where(models.MarzbanUser.server_id == server.id)
-        )
-        if (used or 0) < server.capacity:
+        if server.users_count < server.capacity:
             return server
     return None
 
@@ -704,6 +2334,11 @@ async def get_or_create_user(init_data: str, session: AsyncSession) -> models.Us
 
     if user:
 
+        if user.bot_blocked_at:
+            # пользователь открыл webapp — уведомления снова доставляемы
+            user.bot_blocked_at = None
+            await session.commit()
+
         return user
     user = models.User(
 
@@ -755,6 +2390,12 @@ async def get_current_user(
     return user
 
 
+async def get_user_read_session(user: models.User = Depends(get_current_user)) -> AsyncSession:
+    # user загружен из основной БД, его updated_at — страховка от отставания реплики
+    async with user_read_session(user.id, user.updated_at) as session:
+        yield session
+
+
 
 
 
@@ -863,6 +2504,7 @@ async def state(user: models.User = Depends(get_current_user), session: AsyncSes
         price_per_day=price_value,
         estimated_days=recalculated["estimated_days"],
         trial_available=not user.trial_claimed,
+        crypto_enabled=cryptopay.enabled,
     )
 
 @app.post("/api/trial")
@@ -873,7 +2515,7 @@ async def claim_trial(user: models.User = Depends(get_current_user), session: As
     if not price_value or price_value <= 0:
         raise HTTPException(status_code=400, detail="trial_unavailable")
     credit = int(math.ceil(price_value))
-    user.balance += credit
+    await apply_balance(session, user.id, credit, models.LEDGER_TRIAL, comment="trial")
     user.trial_claimed = True
     user.trial_expires_at = now_utc() + timedelta(days=1)
     await session.commit()
@@ -883,16 +2525,51 @@ async def claim_trial(user: models.User = Depends(get_current_user), session: As
     return {"ok": True, "balance": user.balance, "estimated_days": recalculated["estimated_days"]}
 
 @app.get("/api/payments", response_model=list[PaymentOut])
-async def list_payments(user: models.User = Depends(get_current_user), session: AsyncSession = Depends(get_session)):
-    payments = (
-        await session.scalars(
-            select(models.Payment)
-            .where(models.Payment.user_id == user.id)
-            .order_by(models.Payment.created_at.desc())
-            .limit(20)
-        )
-    ).all()
-    return payments
+async def list_payments(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    user: models.User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_user_read_session),
+):
+    return await payments_page(session, response, user.id, cursor, limit, models.Payment.status != "expired")
+
+# знаков после запятой в сумме счёта; для остальных активов — CRYPTO_DEFAULT_DECIMALS
+CRYPTO_DECIMALS = {"USDT": 2, "USDC": 2}
+CRYPTO_DEFAULT_DECIMALS = 6
+
+
+async def create_crypto_topup(session: AsyncSession, user: models.User, amount: int) -> dict:
+    if not cryptopay.enabled:
+        raise HTTPException(status_code=400, detail="Оплата криптовалютой недоступна")
+    asset = settings.crypto_pay_asset
+    rate = await cryptopay.rub_rate(asset)
+    if not rate:
+        raise HTTPException(status_code=503, detail="Курс недоступен, попробуйте позже")
+    decimals = CRYPTO_DECIMALS.get(asset, CRYPTO_DEFAULT_DECIMALS)
+    asset_amount = (Decimal(amount) / Decimal(str(rate))).quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_UP)
+
+    payment = models.Payment(user_id=user.id, amount=amount, status="pending", provider="crypto")
+    session.add(payment)
+    await session.commit()
+    await session.refresh(payment)
+
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        invoice = await cryptopay.create_invoice(asset, str(asset_amount), str(payment.id), f"1VPN topup #{payment.id}")
+        outcome = "ok"
+    except Exception as e:
+        await session.delete(payment)
+        await session.commit()
+        raise HTTPException(status_code=500, detail=f"cryptopay_error: {e}")
+    finally:
+        metrics.observe("cryptopay_create_invoice_seconds", time.monotonic() - started, outcome=outcome)
+    payment.provider_payment_id = str(invoice["invoice_id"])
+    await session.commit()
+    pay_url = invoice.get("bot_invoice_url") or invoice.get("mini_app_invoice_url") or invoice.get("pay_url")
+    return {"confirmation_url": pay_url, "payment_id": payment.id, "asset": asset, "asset_amount": str(asset_amount)}
+
 
 @app.post("/api/topup")
 
@@ -913,6 +2590,8 @@ async def create_topup(
 
 
     provider = (payload.provider or "card").lower()
+    if provider == "crypto":
+        return await create_crypto_topup(session, user, payload.amount)
     if provider not in {"sbp", "card", "all", "any"}:
         raise HTTPException(status_code=400, detail="Only SBP or Card are available")
     if provider == "sbp":
@@ -931,11 +2610,8 @@ async def create_topup(
 
     # YooKassa payment creation (СБП)
     try:
-        from yookassa import Configuration, Payment
         from yookassa.domain.exceptions import ApiError
 
-        Configuration.account_id = settings.yookassa_shop_id
-        Configuration.secret_key = settings.yookassa_secret_key
         amount_value = f"{payload.amount:.2f}"
         idem_key = str(uuid.uuid4())
 
@@ -950,10 +2626,7 @@ async def create_topup(
         }
         if provider == "sbp":
             create_payload["payment_method_data"] = {"type": payment_method_type}
-        payment_response = Payment.create(
-            create_payload,
-            idempotency_key=idem_key,
-        )
+        payment_response = await yookassa_create_payment(create_payload, idem_key)
         payment.provider_payment_id = payment_response.id
 
         await session.commit()
@@ -1050,7 +2723,9 @@ async def start_subscription(
 
 
 
-    user.balance -= total
+    if await apply_balance(session, user.id, -total, models.LEDGER_CHARGE, comment=f"tariff {tariff.id}") is None:
+
+        raise HTTPException(status_code=400, detail="Недостаточно средств на балансе")
 
     user.allowed_devices = payload.devices
 
@@ -1114,15 +2789,13 @@ async def register_device(
 
         await session.commit()
 
-    count = await session.scalar(select(func.count(models.Device.id)).where(models.Device.user_id == user.id))
-
-    device_count = max(count or 0, 1)
+    device_count = max(user.devices_count, 1)
 
     price_value = await get_price(session)
 
-    cost_per_day = price_value * device_count if price_value else 0
+    cost_per_day = daily_charge(price_value, device_count)
 
-    estimated_days = int(user.balance / cost_per_day) if cost_per_day else 0
+    estimated_days = user.balance // cost_per_day if cost_per_day else 0
 
     user.allowed_devices = device_count
 
@@ -1130,7 +2803,7 @@ async def register_device(
 
         expires_at = now_utc() + timedelta(days=estimated_days)
 
-        user.subscription_end = expires_at
+        set_paid_until(user, expires_at)
 
         user.link_suspended = False
 
@@ -1159,7 +2832,7 @@ async def register_device(
 
     await session.commit()
 
-    return {"ok": True, "devices": count}
+    return {"ok": True, "devices": user.devices_count}
 
 
 
@@ -1187,15 +2860,13 @@ async def delete_device(
 
     await session.commit()
 
-    remaining = await session.scalar(select(func.count(models.Device.id)).where(models.Device.user_id == user.id))
-
-    device_count = max(remaining or 0, 1)
+    device_count = max(user.devices_count, 1)
 
     price_value = await get_price(session)
 
-    cost_per_day = price_value * device_count if price_value else 0
+    cost_per_day = daily_charge(price_value, device_count)
 
-    estimated_days = int(user.balance / cost_per_day) if cost_per_day else 0
+    estimated_days = user.balance // cost_per_day if cost_per_day else 0
 
     user.allowed_devices = device_count
 
@@ -1203,7 +2874,7 @@ async def delete_device(
 
         expires_at = now_utc() + timedelta(days=estimated_days)
 
-        user.subscription_end = expires_at
+        set_paid_until(user, expires_at)
 
         user.link_suspended = False
 
@@ -1239,122 +2910,74 @@ async def delete_device(
 
 
 @app.post("/api/webhooks/yookassa")
-
 async def yookassa_hook(request: Request, session: AsyncSession = Depends(get_session)):
-
-    data = await request.json()
-
-    metadata = data.get("object", {}).get("metadata", {})
-
-    payment_id = metadata.get("payment_id")
-
-    status_value = data.get("object", {}).get("status")
-
-    if not payment_id:
-
+    # только проверка и сохранение — провайдер получает ответ сразу, обработка в webhook_worker_loop
+    try:
+        data = await request.json()
+    except Exception:
         return {"ok": False}
-
-    payment: models.Payment | None = await session.get(models.Payment, int(payment_id))
-
-    if not payment or payment.status == "succeeded":
-
-        return {"ok": True}
-
-    if status_value == "succeeded":
-
-        payment.status = "succeeded"
-
-        user = await session.get(models.User, payment.user_id)
-
-        if user:
-
-            user.balance += payment.amount
-
-            await bot.send_message(
-                int(user.telegram_id),
-                f"Баланс пополнен на {payment.amount} ₽",
-                reply_markup=webapp_keyboard(),
-            )
-
-    else:
-
-        payment.status = status_value
-
-    await session.commit()
-
+    if not isinstance(data, dict) or not parse_yookassa_event(data):
+        return {"ok": False}
+    await store_webhook(session, "yookassa", data)
     return {"ok": True}
 
 
 @app.post("/api/webhooks/cryptobot")
 async def cryptobot_hook(request: Request, session: AsyncSession = Depends(get_session)):
-    """
-    Webhook для Crypto Bot. Ждем update_type = invoice_paid и payload с id платежа (payment.id),
-    который передаем в createInvoice.
-    """
+    body = await request.body()
+    if settings.crypto_pay_token and not verify_crypto_pay_signature(
+        body, request.headers.get("crypto-pay-api-signature", ""), settings.crypto_pay_token
+    ):
+        raise HTTPException(status_code=401, detail="Bad signature")
     try:
-        data = await request.json()
-    except Exception:
+        data = json.loads(body)
+    except ValueError:
+        return {"ok": False}
+    if not isinstance(data, dict):
         return {"ok": False}
+    await store_webhook(session, "cryptobot", data)
+    return {"ok": True}
 
-    update_type = data.get("update_type")
-    status_value = (data.get("status") or data.get("invoice", {}).get("status") or "").lower()
-    payload_id = (
-        data.get("payload")
-        or data.get("invoice_payload")
-        or data.get("invoice", {}).get("payload")
-        or data.get("data", {}).get("payload")
-    )
-    invoice_id = data.get("invoice_id") or data.get("invoice", {}).get("invoice_id")
 
-    if update_type != "invoice_paid" or status_value != "paid" or not payload_id:
-        # логируем шум для отладки, но не падаем
-        try:
-            print("cryptobot_hook_skip", {"update_type": update_type, "status": status_value, "payload": payload_id})
-        except Exception:
-            pass
-        return {"ok": True}
+def encode_page_cursor(created_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
 
-    try:
-        payment_pk = int(str(payload_id))
-    except ValueError:
-        payment_pk = None
 
-    payment: models.Payment | None = None
-    if payment_pk:
-        payment = await session.get(models.Payment, payment_pk)
-    if not payment and invoice_id:
-        payment = await session.scalar(
-            select(models.Payment).where(models.Payment.provider_payment_id == str(invoice_id))
-        )
-    if not payment or payment.status == "succeeded":
-        try:
-            print("cryptobot_hook_not_found_or_done", {"payment_pk": payment_pk, "invoice_id": invoice_id})
-        except Exception:
-            pass
-        return {"ok": True}
+def decode_page_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        created_at = datetime.fromisoformat(created_at)
+        return created_at if created_at.tzinfo else created_at.replace(tzinfo=timezone.utc), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Bad cursor")
 
-    payment.status = "succeeded"
-    if invoice_id and not payment.provider_payment_id:
-        payment.provider_payment_id = str(invoice_id)
 
-    user = await session.get(models.User, payment.user_id)
-    if user:
-        user.balance += payment.amount
-        recalculated = await recalc_subscription(session, user)
-        await bot.send_message(
-            int(user.telegram_id),
-            f"Баланс пополнен на {payment.amount} ₽",
-            reply_markup=webapp_keyboard(),
+async def payments_page(
+    session: AsyncSession, response: Response, user_id: int, cursor: Optional[str], limit: int, *conditions
+) -> list[models.Payment]:
+    """
+    Страница истории платежей по ключу (created_at, id) — индекс ix_payments_user_created, без OFFSET.
+    Курсор следующей страницы отдаётся в заголовке X-Next-Cursor.
+    """
+    limit = min(max(limit, 1), 100)
+    query = select(models.Payment).where(models.Payment.user_id == user_id, *conditions)
+    if cursor:
+        created_at, payment_id = decode_page_cursor(cursor)
+        query = query.where(
+            or_(
+                models.Payment.created_at < created_at,
+                and_(models.Payment.created_at == created_at, models.Payment.id < payment_id),
+            )
         )
-        await session.commit()
-        return {"ok": True, "link_suspended": recalculated.get("link_suspended", True)}
-
-    try:
-        print("cryptobot_hook_no_user", {"payment_id": payment.id})
-    except Exception:
-        pass
-    await session.commit()
-    return {"ok": True}
+    payments = (
+        await session.scalars(
+            query.order_by(models.Payment.created_at.desc(), models.Payment.id.desc()).limit(limit + 1)
+        )
+    ).all()
+    if len(payments) > limit:
+        payments = payments[:limit]
+        response.headers["X-Next-Cursor"] = encode_page_cursor(payments[-1].created_at, payments[-1].id)
+    return payments
 
 
 def find_user_query(telegram_id: Optional[str], username: Optional[str]):
@@ -1423,19 +3046,10 @@ async def admin_broadcast(
 
     ensure_admin_user(user)
 
-    users = (await session.scalars(select(models.User))).all()
-
-    for item in users:
-
-        try:
-
-            await bot.send_message(int(item.telegram_id), payload.message, reply_markup=webapp_keyboard())
-
-        except Exception:
+    segment = broadcast_segment_params(payload.segment, payload.days)
+    job = await create_broadcast_job(session, {"text": payload.message, **segment})
 
-            continue
-
-    return {"sent": len(users)}
+    return {"ok": True, "job_id": job.id, "total": job.total}
 
 
 
@@ -1491,7 +3105,8 @@ async def admin_topup(
 
         raise HTTPException(status_code=404, detail="User not found")
 
-    target.balance += payload.amount
+    if await apply_balance(session, target.id, payload.amount, models.LEDGER_ADMIN, comment="admin topup") is None:
+        raise HTTPException(status_code=400, detail="Недостаточно средств на балансе")
     result = await recalc_subscription(session, target)
     return {"ok": True, "balance": target.balance, "link_suspended": result["link_suspended"]}
 
@@ -1507,7 +3122,10 @@ async def admin_ui_debit(
         raise HTTPException(status_code=404, detail="User not found")
     if payload.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
-    target.balance = max(0, target.balance - payload.amount)
+    debit = min(target.balance, payload.amount)
+    if debit > 0:
+        if await apply_balance(session, target.id, -debit, models.LEDGER_ADMIN, comment="admin debit") is None:
+            raise HTTPException(status_code=409, detail="Баланс изменился, повторите списание")
     result = await recalc_subscription(session, target)
     return {"ok": True, "balance": target.balance, "link_suspended": result["link_suspended"]}
 
@@ -1521,10 +3139,9 @@ async def admin_ui_userinfo(
     target = await session.scalar(find_user_query(payload.telegram_id, payload.username))
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
-    device_count = await session.scalar(
-        select(func.count(models.Device.id)).where(models.Device.user_id == target.id)
-    ) or 0
-    rem_user = await session.scalar(select(models.RemUser).where(models.RemUser.user_id == target.id))
+    device_count = target.devices_count
+    async with user_read_session(target.id, target.updated_at) as reader:
+        rem_user = await reader.scalar(select(models.RemUser).where(models.RemUser.user_id == target.id))
     return {
         "balance": target.balance,
         "subscription_end": target.subscription_end,
@@ -1538,6 +3155,36 @@ async def admin_ui_userinfo(
 
 
 
+@app.post("/admin/ui/ledger", response_model=list[LedgerOut])
+async def admin_ui_ledger(
+    payload: AdminLedgerLookup,
+    _: str = Depends(admin_ui_guard),
+    session: AsyncSession = Depends(get_session),
+):
+    target = await session.scalar(find_user_query(payload.telegram_id, payload.username))
+    if not target:
+        raise HTTPException(status_code=404, detail="User not found")
+    async with user_read_session(target.id, target.updated_at) as reader:
+        entries = (
+            await reader.scalars(
+                select(models.BalanceLedger)
+                .where(models.BalanceLedger.user_id == target.id)
+                .order_by(models.BalanceLedger.created_at.desc(), models.BalanceLedger.id.desc())
+                .limit(max(1, min(payload.limit, 500)))
+            )
+        ).all()
+    return entries
+
+
+@app.get("/admin/ui/ledger/check")
+async def admin_ui_ledger_check(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
+    mismatches = await ledger_mismatches(session)
+    return {"ok": not mismatches, "mismatches": mismatches}
+
+
+
+
+
 @app.post("/admin/tariffs", response_model=TariffOut)
 
 async def admin_tariff(
@@ -1698,19 +3345,20 @@ async def admin_ui_broadcast(
 
 ):
 
-    users = (await session.scalars(select(models.User))).all()
-
-    for item in users:
-
-        try:
-
-            await bot.send_message(int(item.telegram_id), payload.message, reply_markup=webapp_keyboard())
+    segment = broadcast_segment_params(payload.segment, payload.days)
+    job = await create_broadcast_job(session, {"text": payload.message, **segment})
 
-        except Exception:
+    return {"ok": True, "job_id": job.id, "total": job.total}
 
-            continue
 
-    return {"sent": len(users)}
+@app.post("/admin/ui/broadcast/count")
+async def admin_ui_broadcast_count(
+    payload: AdminBroadcastSegment,
+    _: str = Depends(admin_ui_guard),
+    session: AsyncSession = Depends(get_read_session),
+):
+    segment = broadcast_segment_params(payload.segment, payload.days)
+    return {**segment, "total": await count_recipients(session, payload.segment, payload.days)}
 
 
 @app.post("/admin/ui/broadcast_photo")
@@ -1719,40 +3367,26 @@ async def admin_ui_broadcast_photo(
     _: str = Depends(admin_ui_guard),
     session: AsyncSession = Depends(get_session),
 ):
-    users = (await session.scalars(select(models.User))).all()
-    sent = 0
-    for item in users:
-        try:
-            await bot.send_photo(
-                int(item.telegram_id),
-                payload.photo_url,
-                caption=payload.message or None,
-                reply_markup=webapp_keyboard(),
-            )
-            sent += 1
-        except Exception:
-            continue
-    return {"sent": sent}
+    segment = broadcast_segment_params(payload.segment, payload.days)
+    job = await create_broadcast_job(session, {"text": payload.message, "photo_url": payload.photo_url, **segment})
+    return {"ok": True, "job_id": job.id, "total": job.total}
 
 
 @app.post("/admin/ui/broadcast_photo_upload")
 async def admin_ui_broadcast_photo_upload(
     message: str = Form(""),
     file: UploadFile = File(...),
+    segment: str = Form("all"),
+    days: Optional[int] = Form(None),
     _: str = Depends(admin_ui_guard),
     session: AsyncSession = Depends(get_session),
 ):
-    users = (await session.scalars(select(models.User))).all()
-    data = await file.read()
-    input_file = types.BufferedInputFile(data, filename=file.filename or "photo.jpg")
-    sent = 0
-    for item in users:
-        try:
-            await bot.send_photo(int(item.telegram_id), input_file, caption=message or None, reply_markup=webapp_keyboard())
-            sent += 1
-        except Exception:
-            continue
-    return {"sent": sent}
+    if file.content_type and not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Нужно изображение")
+    segment_params = broadcast_segment_params(segment, days)
+    photo = await upload_broadcast_photo(file)
+    job = await create_broadcast_job(session, {"text": message, **photo, **segment_params})
+    return {"ok": True, "job_id": job.id, "total": job.total}
 
 
 
@@ -1784,11 +3418,11 @@ async def admin_ui_servers(
 
 @app.get("/admin/ui/servers/list")
 
-async def admin_ui_servers_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
+async def admin_ui_servers_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
 
     servers = (await session.scalars(select(models.Server))).all()
 
-    return {"servers": [{"id": s.id, "name": s.name, "endpoint": s.endpoint, "capacity": s.capacity} for s in servers]}
+    return {"servers": [{"id": s.id, "name": s.name, "endpoint": s.endpoint, "capacity": s.capacity, "users_count": s.users_count} for s in servers]}
 
 
 
@@ -1851,7 +3485,7 @@ async def admin_ui_marzban_servers(
 
 
 @app.get("/admin/ui/marzban/servers/list", response_model=list[MarzbanServerOut])
-async def admin_ui_marzban_servers_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
+async def admin_ui_marzban_servers_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
     servers = (await session.scalars(select(models.MarzbanServer))).all()
     return servers
 
@@ -1885,9 +3519,9 @@ async def admin_ui_rem_squad_create(
 
 
 @app.get("/admin/ui/rem/squads/list")
-async def admin_ui_rem_squad_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
+async def admin_ui_rem_squad_list(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
     squads = (await session.scalars(select(models.RemSquad))).all()
-    return [{"id": s.id, "name": s.name, "uuid": s.uuid, "capacity": s.capacity} for s in squads]
+    return [{"id": s.id, "name": s.name, "uuid": s.uuid, "capacity": s.capacity, "users_count": s.users_count} for s in squads]
 
 
 @app.post("/admin/ui/rem/squads/update")
@@ -1940,6 +3574,15 @@ async def admin_ui_servers_update(
 
 
 
+@app.get("/admin/ui/billing/report")
+async def admin_ui_billing_report(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
+    run = await session.scalar(select(models.BillingRun).order_by(models.BillingRun.id.desc()).limit(1))
+    return json.loads(run.report) if run else {"date": None}
+
+
+
+
+
 @app.get("/admin/ui/price")
 
 async def admin_ui_price(_: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
@@ -1956,7 +3599,124 @@ async def admin_ui_set_price(payload: AdminPrice, _: str = Depends(admin_ui_guar
 
     await set_price(session, payload.price)
 
-    return {"ok": True, "price": await get_price(session)}
+    # предыдущий пересчёт устарел — его место занимает новый
+    await session.execute(
+        update(models.Job)
+        .where(models.Job.kind == "recompute", models.Job.status.in_(("pending", "running", "paused")))
+        .values(status="cancelled", finished_at=now_utc())
+    )
+    total = await session.scalar(select(func.count(models.User.id)).where(models.User.banned.is_(False)))
+    job = models.Job(kind="recompute", params=json.dumps({"price": payload.price}), total=total or 0)
+    session.add(job)
+    await session.commit()
+
+    return {"ok": True, "price": await get_price(session), "job_id": job.id}
+
+
+@app.get("/admin/ui/jobs")
+async def admin_ui_jobs(
+    kind: str | None = None,
+    limit: int = 20,
+    _: str = Depends(admin_ui_guard),
+    session: AsyncSession = Depends(get_read_session),
+):
+    query = select(models.Job).order_by(models.Job.id.desc()).limit(min(max(limit, 1), 100))
+    if kind:
+        query = query.where(models.Job.kind == kind)
+    return [job_to_dict(job) for job in (await session.scalars(query)).all()]
+
+
+@app.post("/admin/ui/jobs/{job_id}/{action}")
+async def admin_ui_job_action(
+    job_id: int, action: str, _: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)
+):
+    if action not in JOB_TRANSITIONS:
+        raise HTTPException(status_code=404, detail="Unknown action")
+    allowed, new_status = JOB_TRANSITIONS[action]
+    job = await session.get(models.Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Not found")
+    was_running = job.status == "running"
+    # условный UPDATE: раннер мог завершить задачу между чтением и записью
+    now = now_utc()
+    values = {"status": new_status}
+    if new_status in ("paused", "cancelled") and job.resumed_at:
+        # отрезок работы закрывается; resume откроет новый, когда раннер возьмёт задачу
+        values["active_seconds"] = job_active_seconds(job, now)
+        values["resumed_at"] = None
+    if new_status == "cancelled":
+        values["finished_at"] = now
+    result = await session.execute(
+        update(models.Job).where(models.Job.id == job_id, models.Job.status.in_(allowed)).values(**values)
+    )
+    await session.commit()
+    if not result.rowcount:
+        raise HTTPException(status_code=409, detail=f"Нельзя выполнить {action} для статуса {job.status}")
+    await session.refresh(job)
+    if new_status == "pending":
+        job_wakeup.set()
+    if new_status == "cancelled" and job.kind == "broadcast" and not was_running:
+        # запущенная рассылка удалит файл сама, когда заметит отмену
+        remove_upload(json.loads(job.params or "{}"))
+    return job_to_dict(job)
+
+
+@app.get("/admin/ui/jobs/{job_id}")
+async def admin_ui_job(job_id: int, _: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_read_session)):
+    job = await session.get(models.Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Not found")
+    return job_to_dict(job)
+
+
+@app.get("/admin/ui/webhooks")
+async def admin_ui_webhooks(
+    status: str = "dead",
+    limit: int = 50,
+    _: str = Depends(admin_ui_guard),
+    session: AsyncSession = Depends(get_read_session),
+):
+    events = (
+        await session.scalars(
+            select(models.WebhookEvent)
+            .where(models.WebhookEvent.status == status)
+            .order_by(models.WebhookEvent.id.desc())
+            .limit(min(max(limit, 1), 200))
+        )
+    ).all()
+    return [
+        {
+            "id": event.id,
+            "provider": event.provider,
+            "status": event.status,
+            "attempts": event.attempts,
+            "error": event.error,
+            "payload": json.loads(event.payload),
+            "created_at": event.created_at,
+        }
+        for event in events
+    ]
+
+
+@app.post("/admin/ui/webhooks/{event_id}/retry")
+async def admin_ui_webhook_retry(event_id: int, _: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
+    result = await session.execute(
+        update(models.WebhookEvent)
+        .where(models.WebhookEvent.id == event_id, models.WebhookEvent.status == "dead")
+        .values(status="pending", attempts=0, next_attempt_at=now_utc())
+    )
+    await session.commit()
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail="Событие не найдено или не в dead-letter")
+    webhook_wakeup.set()
+    return {"ok": True}
+
+
+@app.get("/admin/ui/metrics")
+async def admin_ui_metrics(format: str = "json", _: str = Depends(admin_ui_guard)):
+    if format == "prometheus":
+        return PlainTextResponse(metrics.prometheus())
+    return metrics.snapshot()
 
 
 @app.get("/admin/ui/maintenance")
@@ -1980,19 +3740,17 @@ async def admin_ui_set_maintenance_allow(payload: AdminMaintenanceAllow, _: str
     return {"ok": True, "telegram_ids": ids}
 
 @app.post("/admin/ui/payments", response_model=list[PaymentOut])
-async def admin_ui_payments(payload: AdminUserLookup, _: str = Depends(admin_ui_guard), session: AsyncSession = Depends(get_session)):
+async def admin_ui_payments(
+    payload: AdminPaymentsLookup,
+    response: Response,
+    _: str = Depends(admin_ui_guard),
+    session: AsyncSession = Depends(get_session),
+):
     target = await session.scalar(find_user_query(payload.telegram_id, payload.username))
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
-    payments = (
-        await session.scalars(
-            select(models.Payment)
-            .where(models.Payment.user_id == target.id)
-            .order_by(models.Payment.created_at.desc())
-            .limit(30)
-        )
-    ).all()
-    return payments
+    async with user_read_session(target.id, target.updated_at) as reader:
+        return await payments_page(reader, response, target.id, payload.cursor, payload.limit)
 
 
 
@@ -2033,7 +3791,8 @@ async def admin_ui_topup(
     target = await session.scalar(find_user_query(payload.telegram_id, payload.username))
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
-    target.balance += payload.amount
+    if await apply_balance(session, target.id, payload.amount, models.LEDGER_ADMIN, comment="admin topup") is None:
+        raise HTTPException(status_code=400, detail="Недостаточно средств на балансе")
     result = await recalc_subscription(session, target)
     return {"ok": True, "balance": target.balance, "link_suspended": result["link_suspended"]}
 
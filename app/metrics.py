@@ -0,0 +1,120 @@
+"""
+Небольшой реестр метрик процесса: гистограммы задержек и счётчики с метками.
+Хранится в памяти воркера, отдаётся через /admin/ui/metrics (JSON или формат Prometheus).
+
+Каждый воркер отдаёт только свои значения, поэтому опрашивать нужно все воркеры, а каждая
+серия помечена меткой worker. Счётчики фоновых задач лидера (биллинг, сверки, очереди)
+растут только у текущего лидера (worker_is_leader = 1) и начинаются с нуля у нового лидера
+после смены аренды — для Prometheus это обычный сброс счётчика, rate()/increase() его учитывают;
+суммировать по всем воркерам: sum without (worker) (...).
+"""
+import os
+import socket
+from typing import Iterable
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float | None:
+        # верхняя граница корзины, в которую попал квантиль
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else None,
+            "max": round(self.max, 4),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class Metrics:
+    def __init__(self, worker: str):
+        self.worker = worker
+        self.leader = False  # выставляет leader_loop
+        self.histograms: dict[str, dict[LabelKey, Histogram]] = {}
+        self.counters: dict[str, dict[LabelKey, float]] = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        return {
+            "worker": self.worker,
+            "leader": self.leader,
+            "histograms": {
+                name: [{"labels": dict(key), **hist.snapshot()} for key, hist in series.items()]
+                for name, series in self.histograms.items()
+            },
+            "counters": {
+                name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                for name, series in self.counters.items()
+            },
+        }
+
+    def prometheus(self) -> str:
+        worker = (("worker", self.worker),)
+        lines = ["# TYPE worker_is_leader gauge", f"worker_is_leader{_labels(worker)} {int(self.leader)}"]
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_labels(worker + key)} {value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                key = worker + key
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {hist.count}")
+                lines.append(f"{name}_sum{_labels(key)} {hist.sum}")
+                lines.append(f"{name}_count{_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+metrics = Metrics(worker=f"{socket.gethostname()}:{os.getpid()}")
@@ -0,0 +1,175 @@
+"""
+Версионированные изменения схемы для уже существующих БД.
+
+create_all создаёт только отсутствующие таблицы, поэтому новые колонки и индексы в старых
+таблицах добавляются здесь. Каждый шаг идемпотентен (на свежей БД, созданной create_all,
+он ничего не делает), а применённые версии записываются в schema_migrations.
+"""
+import time
+from typing import Callable
+
+from sqlalchemy import Column, exists, inspect, literal, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+from . import models
+from .utils import now_utc
+
+
+def add_column(conn: Connection, column: Column, not_null_default: str | None = None) -> None:
+    table = column.table.name
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column.name in existing:
+        return
+    ddl = f"ALTER TABLE {table} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+    if not_null_default is not None:
+        ddl += f" NOT NULL DEFAULT {not_null_default}"
+    conn.execute(text(ddl))
+
+
+def create_index(conn: Connection, table, name: str) -> None:
+    index = next(i for i in table.indexes if i.name == name)
+    index.create(conn, checkfirst=True)
+
+
+SCHEMA_LOCK_ID = 0x1F9E_0001
+
+
+SCHEMA_LOCK_WAIT = 300  # сек, сколько воркер SQLite ждёт, пока другой закончит миграции
+
+
+def schema_lock(conn: Connection) -> None:
+    """
+    Воркеры стартуют одновременно: create_all и миграции выполняются по очереди.
+    Вызывается первым в транзакции startup; блокировка снимается её коммитом.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": SCHEMA_LOCK_ID})
+    elif conn.dialect.name == "sqlite":
+        # BEGIN IMMEDIATE сразу берёт блокировку записи; каждая попытка ждёт busy_timeout
+        deadline = time.monotonic() + SCHEMA_LOCK_WAIT
+        while True:
+            try:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                return
+            except OperationalError as exc:
+                if "locked" not in str(exc) or time.monotonic() > deadline:
+                    raise
+
+
+def false_literal(conn: Connection) -> str:
+    return "false" if conn.dialect.name == "postgresql" else "0"
+
+
+def m001_user_expiry(conn: Connection) -> None:
+    users = models.User.__table__
+    add_column(conn, users.c.trial_claimed, false_literal(conn))
+    add_column(conn, users.c.trial_expires_at)
+    add_column(conn, users.c.expiry_warned_at)
+    create_index(conn, users, "ix_users_subscription_end")
+    create_index(conn, users, "ix_users_trial_expires_at")
+
+
+def m002_unreachable_recipients(conn: Connection) -> None:
+    users = models.User.__table__
+    add_column(conn, users.c.bot_blocked_at)
+    create_index(conn, users, "ix_users_bot_blocked_at")
+    add_column(conn, models.Job.__table__.c.blocked, "0")
+
+
+def m003_segment_indexes(conn: Connection) -> None:
+    create_index(conn, models.User.__table__, "ix_users_segment")
+    create_index(conn, models.Payment.__table__, "ix_payments_user_status")
+
+
+def m004_payment_provider_index(conn: Connection) -> None:
+    create_index(conn, models.Payment.__table__, "ix_payments_provider_payment_id")
+
+
+def m005_payment_status_index(conn: Connection) -> None:
+    create_index(conn, models.Payment.__table__, "ix_payments_status_created")
+
+
+def m006_payment_history_index(conn: Connection) -> None:
+    create_index(conn, models.Payment.__table__, "ix_payments_user_created")
+
+
+def m007_lookup_indexes(conn: Connection) -> None:
+    # devices.user_id покрыт uq_device_user_fp, payments.user_id — ix_payments_user_*
+    users = models.User.__table__
+    create_index(conn, users, "ix_users_username")
+    create_index(conn, users, "ix_users_server_sub_end")
+    rem_users = models.RemUser.__table__
+    create_index(conn, rem_users, "ix_rem_users_user_id")
+    create_index(conn, rem_users, "ix_rem_users_squad_id")
+    create_index(conn, models.MarzbanUser.__table__, "ix_marzban_users_server_id")
+
+
+def m008_counters(conn: Connection) -> None:
+    for counter, fk in models.COUNTERS:
+        add_column(conn, counter.class_.__table__.c[counter.key], "0")
+        conn.execute(models.counter_repair(counter, fk))
+
+
+def m009_ledger_opening(conn: Connection) -> None:
+    # пользователи с балансом, но без записей в журнале, получают начальный остаток
+    users = models.User
+    ledger = models.BalanceLedger
+    has_entries = exists().where(ledger.user_id == users.id)
+    conn.execute(
+        ledger.__table__.insert().from_select(
+            ["user_id", "kind", "amount", "balance_after", "created_at"],
+            select(
+                users.id,
+                literal(models.LEDGER_OPENING),
+                users.balance,
+                users.balance,
+                literal(now_utc(), ledger.created_at.type),
+            ).where(users.balance != 0, ~has_entries),
+        )
+    )
+
+
+def m010_job_active_time(conn: Connection) -> None:
+    jobs = models.Job.__table__
+    add_column(conn, jobs.c.active_seconds, "0")
+    add_column(conn, jobs.c.resumed_at)
+    # у начатых задач отрезок работы считается от старта; приостановленные получат его при resume
+    conn.execute(
+        jobs.update()
+        .where(jobs.c.started_at.is_not(None), jobs.c.resumed_at.is_(None), jobs.c.status != "paused")
+        .values(resumed_at=jobs.c.started_at)
+    )
+
+
+def m011_trial_segment_index(conn: Connection) -> None:
+    create_index(conn, models.User.__table__, "ix_users_trial_claimed")
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "user expiry columns and indexes", m001_user_expiry),
+    (2, "unreachable recipients", m002_unreachable_recipients),
+    (3, "broadcast segment indexes", m003_segment_indexes),
+    (4, "payments.provider_payment_id index", m004_payment_provider_index),
+    (5, "payments (status, created_at) index", m005_payment_status_index),
+    (6, "payments (user_id, created_at, id) index", m006_payment_history_index),
+    (7, "hot lookup indexes", m007_lookup_indexes),
+    (8, "denormalized device and occupancy counters", m008_counters),
+    (9, "opening ledger entries", m009_ledger_opening),
+    (10, "job active time", m010_job_active_time),
+    (11, "trial segment index", m011_trial_segment_index),
+]
+
+
+def apply_migrations(conn: Connection) -> list[int]:
+    """Вызывается через conn.run_sync после create_all. Возвращает применённые версии."""
+    table = models.SchemaMigration.__table__
+    done = set(conn.scalars(select(table.c.version)).all())
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version in done:
+            continue
+        step(conn)
+        conn.execute(table.insert().values(version=version, name=name, applied_at=now_utc()))
+        applied.append(version)
+    return applied
@@ -2,33 +2,57 @@ import datetime as dt
 import secrets
 from typing import Optional
 
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String, UniqueConstraint
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Index, Integer, String, Text, UniqueConstraint, event, func, select, update
+from sqlalchemy.orm import Mapped, mapped_column, object_session, relationship
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.util import identity_key
 
 from .database import Base
 
 
+def utcnow() -> dt.datetime:
+    # aware-время: naive datetime asyncpg записывает в timestamptz как локальное время процесса
+    return dt.datetime.now(dt.timezone.utc)
+
+
 def generate_link_slug() -> str:
     return secrets.token_urlsafe(6)
 
 
+# типы записей в журнале баланса
+LEDGER_CHARGE = "charge"
+LEDGER_TOPUP = "topup"
+LEDGER_TRIAL = "trial"
+LEDGER_ADMIN = "admin"
+LEDGER_OPENING = "opening"  # начальный остаток для пользователей, созданных до журнала
+
+
 class User(Base):
     __tablename__ = "users"
+    # сегменты рассылки: активные / приостановленные / истекающие
+    __table_args__ = (
+        Index("ix_users_segment", "banned", "link_suspended", "subscription_end"),
+        Index("ix_users_server_sub_end", "server_id", "subscription_end"),  # занятость сервера
+        Index("ix_users_trial_claimed", "trial_claimed", "banned"),  # сегмент trial
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     telegram_id: Mapped[str] = mapped_column(String(64), unique=True, index=True)
-    username: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    username: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
     balance: Mapped[int] = mapped_column(Integer, default=0)  # stored in rubles
-    subscription_end: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+    subscription_end: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), index=True)
     allowed_devices: Mapped[int] = mapped_column(Integer, default=1)
+    devices_count: Mapped[int] = mapped_column(Integer, default=0)  # = COUNT(devices), см. COUNTERS
     link_slug: Mapped[str] = mapped_column(String(32), default=generate_link_slug, unique=True)
     server_id: Mapped[Optional[int]] = mapped_column(ForeignKey("servers.id"))
     banned: Mapped[bool] = mapped_column(Boolean, default=False)
     link_suspended: Mapped[bool] = mapped_column(Boolean, default=False)
     trial_claimed: Mapped[bool] = mapped_column(Boolean, default=False)
-    trial_expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
-    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
+    trial_expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), index=True)
+    expiry_warned_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))  # «осталось < 3 дней» уже отправлено
+    bot_blocked_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), index=True)  # бот заблокирован / чат не найден
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
 
     devices: Mapped[list["Device"]] = relationship("Device", back_populates="user", cascade="all, delete-orphan")
     payments: Mapped[list["Payment"]] = relationship("Payment", back_populates="user", cascade="all, delete-orphan")
@@ -43,7 +67,7 @@ class Device(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     fingerprint: Mapped[str] = mapped_column(String(128))
     label: Mapped[str] = mapped_column(String(64), default="device")
-    last_seen: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    last_seen: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
     user: Mapped["User"] = relationship("User", back_populates="devices")
 
@@ -55,7 +79,8 @@ class Server(Base):
     name: Mapped[str] = mapped_column(String(64), unique=True)
     endpoint: Mapped[str] = mapped_column(String(128))
     capacity: Mapped[int] = mapped_column(Integer, default=10)
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    users_count: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
     users: Mapped[list["User"]] = relationship("User", back_populates="server")
 
@@ -72,25 +97,46 @@ class Tariff(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        Index("ix_payments_user_status", "user_id", "status"),
+        Index("ix_payments_status_created", "status", "created_at"),
+        Index("ix_payments_user_created", "user_id", "created_at", "id"),  # история платежей по страницам
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     amount: Mapped[int] = mapped_column(Integer)
     status: Mapped[str] = mapped_column(String(32), default="pending")
-    provider_payment_id: Mapped[Optional[str]] = mapped_column(String(128))
+    provider_payment_id: Mapped[Optional[str]] = mapped_column(String(128), index=True)
     provider: Mapped[str] = mapped_column(String(32), default="sbp")
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
     user: Mapped["User"] = relationship("User", back_populates="payments")
 
 
+class BalanceLedger(Base):
+    """Журнал изменений баланса (только добавление). users.balance — сумма amount по пользователю."""
+
+    __tablename__ = "balance_ledger"
+    __table_args__ = (Index("ix_balance_ledger_user_created", "user_id", "created_at"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    kind: Mapped[str] = mapped_column(String(16))
+    amount: Mapped[int] = mapped_column(Integer)  # rub, со знаком
+    balance_after: Mapped[int] = mapped_column(Integer)
+    payment_id: Mapped[Optional[int]] = mapped_column(ForeignKey("payments.id"))
+    comment: Mapped[Optional[str]] = mapped_column(String(128))
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
 class AdminCredential(Base):
     __tablename__ = "admin_credentials"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     username: Mapped[str] = mapped_column(String(64), unique=True)
     password: Mapped[str] = mapped_column(String(128))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
 
 class AdminLoginAttempt(Base):
@@ -100,7 +146,7 @@ class AdminLoginAttempt(Base):
     username: Mapped[str] = mapped_column(String(64), index=True)
     ip: Mapped[str] = mapped_column(String(64), index=True)
     attempts: Mapped[int] = mapped_column(Integer, default=0)
-    first_attempt_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    first_attempt_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
     blocked_until: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
 
 
@@ -112,7 +158,7 @@ class AdminLoginRequest(Base):
     ip: Mapped[str] = mapped_column(String(64))
     status: Mapped[str] = mapped_column(String(16), default="pending")
     token: Mapped[Optional[str]] = mapped_column(String(256))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
     expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
     decided_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
 
@@ -122,7 +168,126 @@ class AppSetting(Base):
 
     key: Mapped[str] = mapped_column(String(64), primary_key=True)
     value: Mapped[str] = mapped_column(String(128))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
+class BillingRun(Base):
+    """Итог ежедневного списания; последний отдаёт /admin/ui/billing/report."""
+
+    __tablename__ = "billing_runs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    date: Mapped[str] = mapped_column(String(10), index=True)  # YYYY-MM-DD
+    report: Mapped[str] = mapped_column(Text)  # JSON
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
+class Job(Base):
+    """Фоновая задача (пересчёт после смены цены, рассылка). Выполняется процессом-лидером, cursor — последний обработанный users.id."""
+
+    __tablename__ = "jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32), index=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending", index=True)  # pending/running/paused/cancelled/done/failed
+    params: Mapped[str] = mapped_column(Text, default="{}")  # JSON
+    cursor: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    processed: Mapped[int] = mapped_column(Integer, default=0)
+    succeeded: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    skipped: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(String(512))
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    started_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+    # время работы без пауз: закрытые отрезки в active_seconds, текущий начался в resumed_at
+    active_seconds: Mapped[float] = mapped_column(Float, default=0)
+    resumed_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+    finished_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
+
+
+class Notification(Base):
+    """Outbox уведомлений: пишется в той же транзакции, что и изменение, отправляется диспетчером лидера."""
+
+    __tablename__ = "notifications"
+    __table_args__ = (Index("ix_notifications_due", "status", "next_attempt_at"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    text: Mapped[str] = mapped_column(Text)
+    dedup_key: Mapped[str] = mapped_column(String(128), unique=True)  # paused:{user}:{date}, topup:{payment}, ...
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending/sent/skipped/failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(String(512))
+    next_attempt_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow, index=True)
+    sent_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+
+
+class WebhookEvent(Base):
+    """Входящие webhook'и платёжных систем: сохраняются при приёме и обрабатываются фоновым воркером."""
+
+    __tablename__ = "webhook_inbox"
+    __table_args__ = (Index("ix_webhook_inbox_due", "status", "next_attempt_at"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    provider: Mapped[str] = mapped_column(String(32))
+    payload: Mapped[str] = mapped_column(Text)  # JSON как пришёл
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending/done/dead
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(String(512))
+    next_attempt_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    processed_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+
+
+class IdempotencyKey(Base):
+    """Ответы на запросы с заголовком Idempotency-Key: повтор в пределах TTL получает сохранённый ответ."""
+
+    __tablename__ = "idempotency_keys"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)  # sha256(путь, ключ, кто вызывает)
+    path: Mapped[str] = mapped_column(String(128))
+    request_hash: Mapped[str] = mapped_column(String(64))
+    status: Mapped[str] = mapped_column(String(16), default="processing")  # processing/done
+    status_code: Mapped[Optional[int]] = mapped_column(Integer)
+    response_body: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), index=True)
+
+
+class ProcessedEvent(Base):
+    """Уже обработанные события платёжных webhook'ов: повторная доставка того же события — no-op."""
+
+    __tablename__ = "processed_events"
+    __table_args__ = (UniqueConstraint("provider", "event_id", name="uq_processed_events_provider_event"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    provider: Mapped[str] = mapped_column(String(32))
+    event_id: Mapped[str] = mapped_column(String(160))
+    payment_id: Mapped[Optional[int]] = mapped_column(Integer)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(128))
+    applied_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
+class TaskLease(Base):
+    """Аренда фоновой задачи: её выполняет только процесс-держатель, пока аренда не истекла."""
+
+    __tablename__ = "task_leases"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(128))
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
 
 
 class MarzbanServer(Base):
@@ -133,7 +298,8 @@ class MarzbanServer(Base):
     api_url: Mapped[str] = mapped_column(String(256))
     api_token: Mapped[str] = mapped_column(String(512))
     capacity: Mapped[int] = mapped_column(Integer, default=10)
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    users_count: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
 
 class MarzbanUser(Base):
@@ -141,11 +307,11 @@ class MarzbanUser(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    server_id: Mapped[int] = mapped_column(ForeignKey("marzban_servers.id"))
+    server_id: Mapped[int] = mapped_column(ForeignKey("marzban_servers.id"), index=True)
     username: Mapped[str] = mapped_column(String(64), unique=True)
     sub_url: Mapped[str] = mapped_column(String(512))
     expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
 
 class RemSquad(Base):
@@ -155,16 +321,88 @@ class RemSquad(Base):
     name: Mapped[str] = mapped_column(String(64))
     uuid: Mapped[str] = mapped_column(String(64), unique=True)
     capacity: Mapped[int] = mapped_column(Integer, default=50)
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    users_count: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
 
 class RemUser(Base):
     __tablename__ = "rem_users"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    squad_id: Mapped[int] = mapped_column(ForeignKey("rem_squads.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    squad_id: Mapped[int] = mapped_column(ForeignKey("rem_squads.id"), index=True)
     panel_uuid: Mapped[str] = mapped_column(String(64), unique=True)
     short_uuid: Mapped[Optional[str]] = mapped_column(String(64))
     subscription_url: Mapped[Optional[str]] = mapped_column(String(512))
-    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=dt.datetime.utcnow)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
+
+
+@event.listens_for(Payment, "after_insert")
+@event.listens_for(Payment, "after_update")
+@event.listens_for(Payment, "after_delete")
+def _touch_payment_user(mapper, connection, target):
+    # история платежей читается с реплики: свежий users.updated_at отправляет чтение в основную БД
+    connection.execute(update(User).where(User.id == target.user_id).values(updated_at=utcnow()))
+
+
+# Денормализованные счётчики: (счётчик у родителя, внешний ключ у потомка).
+# Сдвигаются в той же транзакции, что и вставка/удаление/перенос потомка (события ниже);
+# массовые insert()/delete() мимо ORM их не трогают — расхождения чинит counters_loop.
+# У Server счётчик — все назначенные пользователи, активных среди них не больше.
+COUNTERS = (
+    (User.devices_count, Device.user_id),
+    (RemSquad.users_count, RemUser.squad_id),
+    (MarzbanServer.users_count, MarzbanUser.server_id),
+    (Server.users_count, User.server_id),
+)
+
+
+def counter_actual(counter, fk):
+    return select(func.count()).select_from(fk.class_).where(fk == counter.class_.id).scalar_subquery()
+
+
+def counter_repair(counter, fk):
+    """UPDATE, выставляющий счётчик по факту там, где он разошёлся с COUNT."""
+    actual = counter_actual(counter, fk)
+    return update(counter.class_).where(counter != actual).values({counter.key: actual})
+
+
+def _bump(connection, target, counter, parent_id, delta: int) -> None:
+    if parent_id is None:
+        return
+    parent = counter.class_
+    value = connection.execute(
+        update(parent).where(parent.id == parent_id).values({counter.key: counter + delta}).returning(counter)
+    ).scalar()
+    # загруженный в сессию родитель сразу видит новое значение (expire_on_commit=False)
+    session = object_session(target)
+    if value is not None and session is not None:
+        loaded = session.identity_map.get(identity_key(parent, parent_id))
+        if loaded is not None:
+            set_committed_value(loaded, counter.key, value)
+
+
+def _track(counter, fk) -> None:
+    child = fk.class_
+
+    @event.listens_for(child, "after_insert")
+    def _inserted(mapper, connection, target):
+        _bump(connection, target, counter, getattr(target, fk.key), 1)
+
+    @event.listens_for(child, "after_delete")
+    def _deleted(mapper, connection, target):
+        _bump(connection, target, counter, getattr(target, fk.key), -1)
+
+    @event.listens_for(child, "after_update")
+    def _moved(mapper, connection, target):
+        history = get_history(target, fk.key)
+        if not history.has_changes():
+            return
+        for old in history.deleted:
+            _bump(connection, target, counter, old, -1)
+        for new in history.added:
+            _bump(connection, target, counter, new, 1)
+
+
+for _counter, _fk in COUNTERS:
+    _track(_counter, _fk)
@@ -47,6 +47,7 @@ class UserState(BaseModel):
     estimated_days: int
     is_admin: bool
     trial_available: bool
+    crypto_enabled: bool = False
 
 
 class PaymentRequest(BaseModel):
@@ -64,6 +65,17 @@ class PaymentOut(BaseModel):
         from_attributes = True
 
 
+class LedgerOut(BaseModel):
+    id: int
+    kind: str
+    amount: int
+    balance_after: int
+    payment_id: Optional[int]
+    comment: Optional[str]
+    created_at: dt.datetime
+    model_config = {"from_attributes": True}
+
+
 class SubscriptionRequest(BaseModel):
     tariff_id: int
     devices: int
@@ -74,11 +86,16 @@ class DeviceRequest(BaseModel):
     label: str = "device"
 
 
-class AdminBroadcast(BaseModel):
+class AdminBroadcastSegment(BaseModel):
+    segment: str = "all"  # all / active / suspended / trial / never_paid / expiring
+    days: Optional[int] = None  # для expiring
+
+
+class AdminBroadcast(AdminBroadcastSegment):
     message: str
 
 
-class AdminBroadcastPhoto(BaseModel):
+class AdminBroadcastPhoto(AdminBroadcastSegment):
     message: str
     photo_url: str
 
@@ -106,6 +123,19 @@ class AdminUserLookup(BaseModel):
     username: Optional[str] = None
 
 
+class AdminLedgerLookup(BaseModel):
+    telegram_id: Optional[str] = None
+    username: Optional[str] = None
+    limit: int = 50
+
+
+class AdminPaymentsLookup(BaseModel):
+    telegram_id: Optional[str] = None
+    username: Optional[str] = None
+    cursor: Optional[str] = None  # X-Next-Cursor предыдущей страницы
+    limit: int = 30
+
+
 class AdminTariff(BaseModel):
     name: str
     days: int
@@ -1,10 +1,9 @@
 import datetime as dt
-import datetime as dt
 import hmac
 import json
 import secrets
 from hashlib import sha256
-from typing import Optional
+from typing import Callable, Optional
 
 from fastapi import HTTPException, status
 from itsdangerous import BadSignature, TimestampSigner
@@ -36,7 +35,25 @@ def validate_telegram_webapp_data(init_data: str, bot_token: str) -> dict:
     return user
 
 
+def verify_crypto_pay_signature(body: bytes, signature: str, token: str) -> bool:
+    """Crypto Pay: HMAC-SHA256 тела запроса, ключ — SHA256 от токена приложения."""
+    secret = sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+_clock: Optional[Callable[[], dt.datetime]] = None
+
+
+def set_clock(clock: Optional[Callable[[], dt.datetime]]) -> None:
+    """Подменяет источник времени (симулятор биллинга). None возвращает системные часы."""
+    global _clock
+    _clock = clock
+
+
 def now_utc() -> dt.datetime:
+    if _clock is not None:
+        return _clock()
     return dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
 
 
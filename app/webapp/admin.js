@@ -2,6 +2,7 @@ let token = localStorage.getItem("admin_ui_token") || "";
 const el = (id) => document.getElementById(id);
 const statusLine = () => el("status-line");
 let statusTimer = null;
+let jobsTimer = null;
 
 function showToast(msg, ok = true) {
   const box = el("toast-container");
@@ -23,12 +24,24 @@ function setStatus(msg, ok = true) {
    showToast(msg, ok);
 }
 
-async function api(path, body) {
-  const res = await fetch(path, {
-    method: "POST",
-    headers: { "Content-Type": "application/json", ...(token ? { "X-Admin-Token": token } : {}) },
-    body: body ? JSON.stringify(body) : undefined,
-  });
+function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+  return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+}
+
+async function api(path, body, withCursor = false, idempotencyKey = null) {
+  const request = () =>
+    fetch(path, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        ...(token ? { "X-Admin-Token": token } : {}),
+        ...(idempotencyKey ? { "Idempotency-Key": idempotencyKey } : {}),
+      },
+      body: body ? JSON.stringify(body) : undefined,
+    });
+  // с Idempotency-Key повтор после обрыва сети безопасен: сервер вернёт сохранённый ответ
+  const res = await request().catch((e) => (idempotencyKey ? request() : Promise.reject(e)));
   if (res.status === 401) {
     token = "";
     localStorage.removeItem("admin_ui_token");
@@ -39,6 +52,7 @@ async function api(path, body) {
     const data = await res.json().catch(() => ({}));
     throw new Error(data.detail || res.statusText);
   }
+  if (withCursor) return { items: await res.json(), next: res.headers.get("X-Next-Cursor") };
   return res.json();
 }
 
@@ -52,6 +66,7 @@ function showPanel() {
   loadPrice();
   loadMaintenance();
   loadMaintenanceAllow();
+  startJobsPoll();
 }
 
 el("login-btn").onclick = async () => {
@@ -80,29 +95,47 @@ el("save-creds").onclick = async () => {
   }
 };
 
+function broadcastSegment() {
+  const segment = el("broadcast-segment")?.value || "all";
+  const days = parseInt(el("broadcast-days")?.value, 10);
+  return { segment, days: segment === "expiring" && days > 0 ? days : null };
+}
+
+el("broadcast-count").onclick = async () => {
+  try {
+    const res = await api("/admin/ui/broadcast/count", broadcastSegment());
+    setStatus(`Получателей: ${res.total}`);
+  } catch (e) {
+    setStatus(e.message, false);
+  }
+};
+
 el("broadcast-btn").onclick = async () => {
   const message = el("broadcast-text").value.trim();
   const photoInput = el("broadcast-photo");
   const file = photoInput?.files?.[0];
+  const segment = broadcastSegment();
   if (!message && !file) return setStatus("Введите текст или выберите фото", false);
   try {
     if (file) {
       const form = new FormData();
       form.append("message", message);
       form.append("file", file);
+      form.append("segment", segment.segment);
+      if (segment.days) form.append("days", segment.days);
       const res = await fetch("/admin/ui/broadcast_photo_upload", {
         method: "POST",
         headers: { ...(token ? { "X-Admin-Token": token } : {}) },
         body: form,
       });
-      if (!res.ok) {
-        const data = await res.json().catch(() => ({}));
-        throw new Error(data.detail || res.statusText);
-      }
-      setStatus("Рассылка с фото отправлена");
+      const data = await res.json().catch(() => ({}));
+      if (!res.ok) throw new Error(data.detail || res.statusText);
+      setStatus(`Рассылка с фото запущена (#${data.job_id}, получателей ${data.total})`);
+      if (data.job_id) pollJob(data.job_id, "Рассылка");
     } else {
-      await api("/admin/ui/broadcast", { message });
-      setStatus("Рассылка отправлена");
+      const data = await api("/admin/ui/broadcast", { message, ...segment });
+      setStatus(`Рассылка запущена (#${data.job_id}, получателей ${data.total})`);
+      if (data.job_id) pollJob(data.job_id, "Рассылка");
     }
   } catch (e) {
     setStatus(e.message, false);
@@ -245,7 +278,7 @@ el("admin-topup").onclick = async () => {
   const amount = parseInt(amountField.value, 10) || 0;
   if (!body || !amount) return setStatus("Укажите пользователя и сумму", false);
   try {
-    const res = await api("/admin/ui/topup", { ...body, amount });
+    const res = await api("/admin/ui/topup", { ...body, amount }, false, newIdempotencyKey());
     setStatus("Пополнено, баланс: " + res.balance);
     if (infoBlock) infoBlock.innerText = "Баланс: " + res.balance;
   } catch (e) {
@@ -260,7 +293,7 @@ if (debitBtn) {
     const amount = parseInt(amountField.value, 10) || 0;
     if (!body || !amount) return setStatus("Укажите пользователя и сумму", false);
     try {
-      const res = await api("/admin/ui/debit", { ...body, amount });
+      const res = await api("/admin/ui/debit", { ...body, amount }, false, newIdempotencyKey());
       setStatus("Списано, баланс: " + res.balance);
       if (infoBlock) infoBlock.innerText = "Баланс: " + res.balance;
     } catch (e) {
@@ -298,7 +331,7 @@ el("admin-ban").onclick = async () => {
   const body = resolveUserBody();
   if (!body) return setStatus("Укажите пользователя", false);
   try {
-    await api("/admin/ui/ban", { ...body, banned: true });
+    await api("/admin/ui/ban", { ...body, banned: true }, false, newIdempotencyKey());
     setStatus("Пользователь забанен");
     if (infoBtn) infoBtn.click();
   } catch (e) {
@@ -310,7 +343,7 @@ el("admin-unban").onclick = async () => {
   const body = resolveUserBody();
   if (!body) return setStatus("Укажите пользователя", false);
   try {
-    await api("/admin/ui/ban", { ...body, banned: false });
+    await api("/admin/ui/ban", { ...body, banned: false }, false, newIdempotencyKey());
     setStatus("Пользователь разбанен");
     if (infoBtn) infoBtn.click();
   } catch (e) {
@@ -319,26 +352,75 @@ el("admin-unban").onclick = async () => {
 };
 
 const payHistoryBtn = el("admin-payments");
+const payMoreBtn = el("admin-payments-more");
+let paymentsQuery = null;
+
+async function loadPaymentsPage(append) {
+  const page = await api("/admin/ui/payments", paymentsQuery, true);
+  const box = el("admin-payments-list");
+  if (box) {
+    const lines = page.items
+      .map(
+        (p) =>
+          `<div class="line"><span class="label">#${p.id}</span><span class="value">${p.amount} ₽, ${p.provider}, ${p.status}, ${new Date(p.created_at).toLocaleString()}</span></div>`
+      )
+      .join("");
+    if (append) {
+      box.insertAdjacentHTML("beforeend", lines);
+    } else {
+      box.innerHTML = lines || "<div class='label'>Оплат нет</div>";
+    }
+  }
+  paymentsQuery.cursor = page.next;
+  if (payMoreBtn) payMoreBtn.hidden = !page.next;
+}
+
 if (payHistoryBtn) {
   payHistoryBtn.onclick = async () => {
     const body = resolveUserBody();
     if (!body) return setStatus("Укажите пользователя", false);
     try {
-      const list = await api("/admin/ui/payments", body);
-      const box = el("admin-payments-list");
+      paymentsQuery = { ...body, cursor: null };
+      await loadPaymentsPage(false);
+      setStatus("История загрузилась");
+    } catch (e) {
+      setStatus(e.message, false);
+    }
+  };
+}
+
+if (payMoreBtn) {
+  payMoreBtn.onclick = async () => {
+    if (!paymentsQuery?.cursor) return;
+    try {
+      await loadPaymentsPage(true);
+    } catch (e) {
+      setStatus(e.message, false);
+    }
+  };
+}
+
+const ledgerBtn = el("admin-ledger");
+if (ledgerBtn) {
+  ledgerBtn.onclick = async () => {
+    const body = resolveUserBody();
+    if (!body) return setStatus("Укажите пользователя", false);
+    try {
+      const list = await api("/admin/ui/ledger", body);
+      const box = el("admin-ledger-list");
       if (box) {
         if (!list.length) {
-          box.innerHTML = "<div class='label'>Оплат нет</div>";
+          box.innerHTML = "<div class='label'>Записей нет</div>";
         } else {
           box.innerHTML = list
             .map(
-              (p) =>
-                `<div class="line"><span class="label">#${p.id}</span><span class="value">${p.amount} ₽, ${p.provider}, ${p.status}, ${new Date(p.created_at).toLocaleString()}</span></div>`
+              (e) =>
+                `<div class="line"><span class="label">${e.kind}</span><span class="value">${e.amount > 0 ? "+" : ""}${e.amount} ₽ → ${e.balance_after} ₽, ${new Date(e.created_at).toLocaleString()}</span></div>`
             )
             .join("");
         }
       }
-      setStatus("История загрузилась");
+      setStatus("Журнал загружен");
     } catch (e) {
       setStatus(e.message, false);
     }
@@ -358,12 +440,136 @@ async function loadPrice() {
   }
 }
 
+async function getJson(path) {
+  const res = await fetch(path, { headers: { ...(token ? { "X-Admin-Token": token } : {}) } });
+  if (!res.ok) throw new Error(res.statusText);
+  return res.json();
+}
+
+function formatEta(seconds) {
+  if (seconds == null) return "—";
+  if (seconds < 60) return `${seconds} с`;
+  return `${Math.floor(seconds / 60)} мин ${seconds % 60} с`;
+}
+
+function jobLine(job) {
+  let line = `${job.processed}/${job.total}, успешно ${job.succeeded}, ошибок ${job.failed}`;
+  if (job.kind === "broadcast") line += `, недоступны ${job.blocked}`;
+  if (job.rate) line += job.kind === "broadcast" ? `, ${job.rate} сообщ./с` : `, ${job.rate}/с`;
+  if (["pending", "running"].includes(job.status)) line += `, осталось ${formatEta(job.eta_seconds)}`;
+  return line;
+}
+
+async function loadBroadcastJobs() {
+  const box = el("broadcast-jobs");
+  if (!box) return;
+  try {
+    const jobs = await getJson("/admin/ui/jobs?kind=broadcast&limit=5");
+    box.innerHTML = jobs
+      .map((job) => {
+        const actions = [];
+        if (["pending", "running"].includes(job.status)) actions.push(["pause", "Пауза"]);
+        if (job.status === "paused") actions.push(["resume", "Продолжить"]);
+        if (["pending", "running", "paused"].includes(job.status)) actions.push(["cancel", "Отменить"]);
+        const buttons = actions
+          .map(([action, title]) => `<button class="ghost" data-job="${job.id}" data-action="${action}">${title}</button>`)
+          .join("");
+        return `<div class="line"><span class="label">#${job.id} ${job.status}</span><span class="value">${jobLine(job)}</span>${buttons}</div>`;
+      })
+      .join("");
+  } catch {
+    /* ignore */
+  }
+}
+
+const broadcastJobsBox = el("broadcast-jobs");
+if (broadcastJobsBox) {
+  broadcastJobsBox.onclick = async (event) => {
+    const button = event.target.closest("button[data-action]");
+    if (!button) return;
+    try {
+      const job = await api(`/admin/ui/jobs/${button.dataset.job}/${button.dataset.action}`);
+      setStatus(`Рассылка #${job.id}: ${job.status}`);
+    } catch (e) {
+      setStatus(e.message, false);
+    }
+    loadBroadcastJobs();
+  };
+}
+
+function startJobsPoll() {
+  loadBroadcastJobs();
+  if (jobsTimer) clearInterval(jobsTimer);
+  jobsTimer = setInterval(loadBroadcastJobs, 5000);
+}
+
+function pollJob(jobId, label) {
+  const timer = setInterval(async () => {
+    try {
+      const job = await getJson(`/admin/ui/jobs/${jobId}`);
+      const line = `${label}: ${jobLine(job)}`;
+      const s = statusLine();
+      if (s) s.textContent = line;
+      if (!["pending", "running"].includes(job.status)) {
+        clearInterval(timer);
+        setStatus(`${label}: ${job.status}`, job.status === "done");
+      }
+    } catch {
+      clearInterval(timer);
+    }
+  }, 2000);
+}
+
+async function loadDeadWebhooks() {
+  const box = el("webhooks-dead-list");
+  if (!box) return;
+  try {
+    const events = await getJson("/admin/ui/webhooks?status=dead");
+    box.innerHTML = events.length ? "" : "<div class='label'>Нет событий с ошибками</div>";
+    // provider и error приходят из тела webhook'а — только через textContent
+    events.forEach((e) => {
+      const row = document.createElement("div");
+      row.className = "line";
+      const label = document.createElement("span");
+      label.className = "label";
+      label.textContent = `#${e.id} ${e.provider}, попыток ${e.attempts}`;
+      const error = document.createElement("span");
+      error.className = "value";
+      error.textContent = e.error || "";
+      const retry = document.createElement("button");
+      retry.className = "ghost";
+      retry.dataset.webhook = e.id;
+      retry.textContent = "Повторить";
+      row.appendChild(label);
+      row.appendChild(error);
+      row.appendChild(retry);
+      box.appendChild(row);
+    });
+  } catch (e) {
+    setStatus(e.message, false);
+  }
+}
+
+el("webhooks-dead").onclick = loadDeadWebhooks;
+el("webhooks-dead-list").onclick = async (event) => {
+  const button = event.target.closest("button[data-webhook]");
+  if (!button) return;
+  try {
+    await api(`/admin/ui/webhooks/${button.dataset.webhook}/retry`);
+    setStatus(`Событие #${button.dataset.webhook} поставлено в очередь`);
+  } catch (e) {
+    setStatus(e.message, false);
+  }
+  loadDeadWebhooks();
+};
+
 el("save-price").onclick = async () => {
   const price = parseFloat(el("price-day").value) || 0;
   if (!price) return setStatus("Укажите цену", false);
   try {
-    await api("/admin/ui/price", { price });
+    const res = await api("/admin/ui/price", { price });
     setStatus("Цена сохранена");
+    if (res.job_id) pollJob(res.job_id, "Пересчёт подписок");
   } catch (e) {
     setStatus(e.message, false);
   }
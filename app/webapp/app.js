@@ -55,10 +55,17 @@ function randomId() {
   return "xxxxxxx".replace(/x/g, function () { return Math.floor(Math.random() * 16).toString(16); });
 }
 
+function newIdempotencyKey() {
+  if (window.crypto && window.crypto.randomUUID) return window.crypto.randomUUID();
+  return Date.now().toString(36) + "-" + randomId() + randomId();
+}
+
 function api(path, options) {
   options = options || {};
   var headers = options.headers || {};
   headers["Content-Type"] = "application/json";
+  // один ключ на действие: повтор после обрыва сети сервер не выполнит второй раз
+  if (options.idempotencyKey) headers["Idempotency-Key"] = options.idempotencyKey;
   var initVal = (tg && tg.initData) || initData || "";
   headers["X-Telegram-Init"] = initVal;
 
@@ -81,16 +88,30 @@ function api(path, options) {
     }
   }
 
-  return fetch(path, {
-    method: options.method || "GET",
-    headers: headers,
-    body: body ? JSON.stringify(body) : undefined,
-  }).then(function (res) {
+  var request = function () {
+    return fetch(path, {
+      method: options.method || "GET",
+      headers: headers,
+      body: body ? JSON.stringify(body) : undefined,
+    });
+  };
+  var sent = request();
+  if (options.idempotencyKey) {
+    sent = sent.catch(function () {
+      return request();
+    });
+  }
+  return sent.then(function (res) {
     if (!res.ok) {
       return res.json().catch(function () { return {}; }).then(function (data) {
         throw new Error(data.detail || res.statusText);
       });
     }
+    if (options.withCursor) {
+      return res.json().then(function (data) {
+        return { items: data, next: res.headers.get("X-Next-Cursor") };
+      });
+    }
     return res.json();
   });
 }
@@ -248,7 +269,7 @@ function topup() {
 }
 
 function claimTrial() {
-  api("/api/trial", { method: "POST" })
+  api("/api/trial", { method: "POST", idempotencyKey: newIdempotencyKey() })
     .then(function () {
       loadState().catch(function () {});
     })
@@ -263,39 +284,57 @@ function deleteDevice(id) {
   api("/api/device/" + id, { method: "DELETE" }).then(loadState).catch(function () { });
 }
 
+function paymentLines(list) {
+  return list
+    .map(function (p) {
+      return (
+        "<div class='line'><span class='label'>#" +
+        p.id +
+        "</span><span class='value'>" +
+        p.amount +
+        " ₽, " +
+        (p.provider || "") +
+        ", " +
+        (p.status || "") +
+        ", " +
+        new Date(p.created_at).toLocaleString() +
+        "</span></div>"
+      );
+    })
+    .join("");
+}
+
 function showPayments() {
-  api("/api/payments")
-    .then(function (list) {
+  api("/api/payments", { withCursor: true })
+    .then(function (page) {
       var backdrop = document.createElement("div");
       backdrop.className = "modal-backdrop";
       var card = document.createElement("div");
       card.className = "modal-card";
-      var html = "<h3>История пополнений</h3>";
-      if (!list.length) {
+      var html = "<h3>История пополнений</h3><div id='payments-lines'>";
+      if (!page.items.length) {
         html += "<div class='label'>Нет платежей</div>";
       } else {
-        html += list
-          .map(function (p) {
-            return (
-              "<div class='line'><span class='label'>#" +
-              p.id +
-              "</span><span class='value'>" +
-              p.amount +
-              " ₽, " +
-              (p.provider || "") +
-              ", " +
-              (p.status || "") +
-              ", " +
-              new Date(p.created_at).toLocaleString() +
-              "</span></div>"
-            );
-          })
-          .join("");
+        html += paymentLines(page.items);
       }
-      html += "<div class='modal-actions'><button class='accent' id='close-payments'>Закрыть</button></div>";
+      html += "</div><div class='modal-actions'>";
+      html += "<button class='ghost' id='more-payments'>Показать ещё</button>";
+      html += "<button class='accent' id='close-payments'>Закрыть</button></div>";
       card.innerHTML = html;
       backdrop.appendChild(card);
       document.body.appendChild(backdrop);
+      var next = page.next;
+      var more = card.querySelector("#more-payments");
+      more.hidden = !next;
+      more.onclick = function () {
+        api("/api/payments?cursor=" + encodeURIComponent(next), { withCursor: true })
+          .then(function (nextPage) {
+            card.querySelector("#payments-lines").insertAdjacentHTML("beforeend", paymentLines(nextPage.items));
+            next = nextPage.next;
+            more.hidden = !next;
+          })
+          .catch(function () { });
+      };
       card.querySelector("#close-payments").onclick = function () {
         backdrop.remove();
       };
@@ -340,7 +379,8 @@ function canAffordDevices(desired, current) {
   var balance = Number(state.balance || 0);
   var price = Number(state.price_per_day || 0);
   if (!price) return false;
-  return balance >= price * desired;
+  // сутки списываются целыми рублями (округление вверх), как на сервере
+  return balance >= Math.ceil(price * desired);
 }
 
 function showInsufficientDevices(desired) {
@@ -376,7 +416,11 @@ function adjustDevices(desired) {
       return p.then(function () {
         var fp = randomId();
         var label = "Устройство " + (current + idx + 1);
-        return api("/api/device", { method: "POST", body: { fingerprint: fp, label: label } });
+        return api("/api/device", {
+          method: "POST",
+          body: { fingerprint: fp, label: label },
+          idempotencyKey: newIdempotencyKey(),
+        });
       });
     }, Promise.resolve());
   } else if (desired < current) {
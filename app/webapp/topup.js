@@ -38,17 +38,26 @@ function openPayUrl(url) {
   window.location.href = url;
 }
 
+function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+  return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+}
+
 async function api(path, options = {}) {
   const initVal = initData || "";
-  const res = await fetch(path, {
-    method: options.method || "GET",
-    headers: {
-      "Content-Type": "application/json",
-      "X-Telegram-Init": initVal,
-      ...(options.headers || {}),
-    },
-    body: options.body ? JSON.stringify(options.body) : undefined,
-  });
+  const request = () =>
+    fetch(path, {
+      method: options.method || "GET",
+      headers: {
+        "Content-Type": "application/json",
+        "X-Telegram-Init": initVal,
+        ...(options.idempotencyKey ? { "Idempotency-Key": options.idempotencyKey } : {}),
+        ...(options.headers || {}),
+      },
+      body: options.body ? JSON.stringify(options.body) : undefined,
+    });
+  // с Idempotency-Key повтор после обрыва сети безопасен: сервер вернёт сохранённый ответ
+  const res = await request().catch((e) => (options.idempotencyKey ? request() : Promise.reject(e)));
   if (!res.ok) {
     const data = await res.json().catch(() => ({}));
     throw new Error(data.detail || res.statusText);
@@ -56,16 +65,27 @@ async function api(path, options = {}) {
   return res.json();
 }
 
+let topupInFlight = false;
+
 async function topup() {
   const input = el("topup-amount");
   const amount = parseInt(input.value, 10);
   if (Number.isNaN(amount) || amount < 50) return alert("Минимум 50₽");
+  // повторное нажатие, пока платёж создаётся, не создаёт второй
+  if (topupInFlight) return;
+  topupInFlight = true;
   try {
-    const data = await api("/api/topup", { method: "POST", body: { amount, provider, initData } });
+    const data = await api("/api/topup", {
+      method: "POST",
+      body: { amount, provider, initData },
+      idempotencyKey: newIdempotencyKey(),
+    });
     if (!data.confirmation_url) return alert("Не удалось получить ссылку оплаты");
     openPayUrl(data.confirmation_url);
   } catch (e) {
     alert(e.message);
+  } finally {
+    topupInFlight = false;
   }
 }
 
@@ -110,12 +130,17 @@ document.querySelectorAll(".quick button").forEach((btn) => {
   });
 });
 
+function providerHint() {
+  if (provider === "crypto") return "Криптовалюта (@CryptoBot)";
+  return provider === "sbp" ? "СБП" : "Карта";
+}
+
 document.querySelectorAll(".provider-btn").forEach((btn) => {
   bindTap(btn, () => {
     document.querySelectorAll(".provider-btn").forEach((b) => b.classList.remove("active"));
     btn.classList.add("active");
     provider = btn.dataset.provider || "card";
-    el("hint").textContent = provider === "sbp" ? "СБП" : "Карта";
+    el("hint").textContent = providerHint();
   });
 });
 
@@ -123,16 +148,19 @@ async function loadPrice() {
   try {
     const state = await api("/api/state");
     pricePerDay = state.price_per_day || 10;
-    const month = Math.ceil(pricePerDay * 30);
-    const three = Math.ceil(pricePerDay * 90);
-    const year = Math.ceil(pricePerDay * 365);
+    if (state.crypto_enabled && el("provider-crypto")) el("provider-crypto").hidden = false;
+    // сутки списываются целыми рублями (округление вверх), как на сервере
+    const daily = Math.ceil(pricePerDay);
+    const month = daily * 30;
+    const three = daily * 90;
+    const year = daily * 365;
     const buttons = el("quick-buttons")?.querySelectorAll("button");
     const values = [month, three, year];
     buttons?.forEach((b, idx) => {
       b.textContent = "+" + values[idx];
       b.dataset.amount = values[idx];
     });
-    el("hint").textContent = provider === "sbp" ? "СБП" : "Карта";
+    el("hint").textContent = providerHint();
   } catch {
     // ignore
   }
@@ -0,0 +1,191 @@
+"""
+Нагрузочный тест SQLite: смешанная нагрузка (пополнение баланса + чтение истории платежей)
+с профилем PRAGMA (app/database.py) и без него. Каждый режим запускается отдельным процессом,
+так как движок БД создаётся при импорте приложения.
+
+Перед нагрузкой проверяются планы горячих запросов (EXPLAIN QUERY PLAN): если какой-то из них
+читает таблицу полным сканированием, бенчмарк завершается с кодом 1.
+
+    python bench_sqlite.py --users 2000 --seconds 10 --workers 32 --write-share 0.3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="1VPN SQLite benchmark")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=32, help="одновременных клиентов")
+    parser.add_argument("--write-share", type=float, default=0.3, help="доля операций записи")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--run-mode", choices=("on", "off"), default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_child(args: argparse.Namespace) -> None:
+    workdir = tempfile.mkdtemp(prefix="1vpn-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SQLITE_PROFILE"] = "1" if args.run_mode == "on" else "0"
+    for key, value in {
+        "BOT_TOKEN": "123456:bench",
+        "WEBAPP_URL": "https://example.invalid",
+        "YOOKASSA_SHOP_ID": "bench",
+        "YOOKASSA_SECRET_KEY": "bench",
+        "ADMIN_SECRET": "bench",
+    }.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from sqlalchemy import func, insert, select, text, update
+    from sqlalchemy.exc import OperationalError
+
+    from app import models
+    from app.database import AsyncReadSessionLocal, AsyncSessionLocal, Base, engine, read_engine
+    from app.migrations import apply_migrations
+    from app.utils import now_utc
+
+    now = now_utc()
+    hot_queries = {
+        "devices by user": select(func.count(models.Device.id)).where(models.Device.user_id == 1),
+        "rem user by user": select(models.RemUser).where(models.RemUser.user_id == 1),
+        "rem squad occupancy": select(func.count(models.RemUser.id)).where(models.RemUser.squad_id == 1),
+        "marzban server occupancy": select(func.count(models.MarzbanUser.id)).where(models.MarzbanUser.server_id == 1),
+        "server occupancy": select(func.count(models.User.id)).where(
+            models.User.server_id == 1, models.User.subscription_end.is_not(None), models.User.subscription_end > now
+        ),
+        "trial segment": select(func.count(models.User.id)).where(
+            models.User.banned.is_(False), models.User.bot_blocked_at.is_(None), models.User.trial_claimed.is_(True)
+        ),
+        "user by telegram_id": select(models.User).where(models.User.telegram_id == "1"),
+        "user by username": select(models.User).where(models.User.username == "bench"),
+        "payments page": select(models.Payment)
+        .where(models.Payment.user_id == 1)
+        .order_by(models.Payment.created_at.desc(), models.Payment.id.desc())
+        .limit(20),
+        "payment by provider id": select(models.Payment).where(models.Payment.provider_payment_id == "x"),
+    }
+
+    async def full_scans() -> list[str]:
+        failures = []
+        async with engine.connect() as conn:
+            for name, query in hot_queries.items():
+                sql = str(query.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+                plan = [row[-1] for row in (await conn.execute(text("EXPLAIN QUERY PLAN " + sql))).all()]
+                # SEARCH ... USING INDEX — поиск по индексу, SCAN <table> — полный проход
+                if any(step.startswith("SCAN ") for step in plan):
+                    failures.append(f"{name}: {'; '.join(plan)}")
+        return failures
+
+    async def seed() -> None:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(apply_migrations)
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                insert(models.User),
+                [{"id": i, "telegram_id": str(i), "link_slug": f"b{i}", "balance": 0} for i in range(1, args.users + 1)],
+            )
+            await session.commit()
+
+    async def write(rng: random.Random) -> None:
+        user_id = rng.randint(1, args.users)
+        async with AsyncSessionLocal() as session:
+            session.add(models.Payment(user_id=user_id, amount=100, status="succeeded", provider="card"))
+            await session.execute(
+                update(models.User).where(models.User.id == user_id).values(balance=models.User.balance + 100)
+            )
+            await session.commit()
+
+    async def read(rng: random.Random) -> None:
+        async with AsyncReadSessionLocal() as session:
+            await session.scalars(
+                select(models.Payment)
+                .where(models.Payment.user_id == rng.randint(1, args.users))
+                .order_by(models.Payment.created_at.desc(), models.Payment.id.desc())
+                .limit(20)
+            )
+
+    async def bench() -> dict:
+        await seed()
+        scans = await full_scans()
+        stats = {"reads": 0, "writes": 0, "locked": 0, "errors": 0}
+        latencies: dict[str, list[float]] = {"read": [], "write": []}
+        deadline = time.monotonic() + args.seconds
+
+        async def worker(n: int) -> None:
+            rng = random.Random(args.seed * 1000 + n)
+            while time.monotonic() < deadline:
+                kind = "write" if rng.random() < args.write_share else "read"
+                started = time.monotonic()
+                try:
+                    await (write(rng) if kind == "write" else read(rng))
+                    stats[kind + "s"] += 1
+                    latencies[kind].append(time.monotonic() - started)
+                except OperationalError as exc:
+                    stats["locked" if "locked" in str(exc) else "errors"] += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker(n) for n in range(args.workers)))
+        elapsed = time.monotonic() - started
+        await engine.dispose()
+        await read_engine.dispose()
+        return {
+            "mode": args.run_mode,
+            "ops_per_sec": round((stats["reads"] + stats["writes"]) / elapsed, 1),
+            "writes_per_sec": round(stats["writes"] / elapsed, 1),
+            "read_p95_ms": round(percentile(latencies["read"], 0.95) * 1000, 2),
+            "write_p95_ms": round(percentile(latencies["write"], 0.95) * 1000, 2),
+            "full_scans": scans,
+            **stats,
+        }
+
+    try:
+        print(json.dumps(asyncio.run(bench())))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.run_mode:
+        run_child(args)
+        return
+    results = []
+    for mode in ("off", "on"):
+        cmd = [sys.executable, os.path.abspath(__file__), "--run-mode", mode]
+        for name in ("users", "seconds", "workers", "write_share", "seed"):
+            cmd += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print("profile | ops/s    | writes/s | read p95 ms | write p95 ms | locked | errors")
+    for r in results:
+        print(
+            f"{r['mode']:7} | {r['ops_per_sec']:8} | {r['writes_per_sec']:8} | {r['read_p95_ms']:11} "
+            f"| {r['write_p95_ms']:12} | {r['locked']:6} | {r['errors']}"
+        )
+    scans = results[-1]["full_scans"]
+    if scans:
+        print("hot queries without an index:")
+        for line in scans:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Симулятор биллинга: прогоняет bill_users_once (и выборочно recalc_subscription) в режиме dry_run
+по синтетическим пользователям или по копии рабочей БД, сдвигая часы на сутки за шаг.
+Панель и Telegram не вызываются.
+
+    python simulate_billing.py --users 100000 --days 60 --price 12
+    python simulate_billing.py --from-db data.db --days 30
+"""
+import argparse
+import asyncio
+import datetime as dt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="1VPN billing simulator (dry run)")
+    parser.add_argument("--users", type=int, default=10_000, help="синтетических пользователей")
+    parser.add_argument("--days", type=int, default=30, help="сколько суток моделировать")
+    parser.add_argument("--from-db", default=None, help="взять копию этой SQLite БД вместо синтетики")
+    parser.add_argument("--price", type=float, default=None, help="цена за день (по умолчанию — из БД/настроек)")
+    parser.add_argument("--max-days-balance", type=int, default=60, help="баланс синтетики: до N дней подписки")
+    parser.add_argument("--topup-rate", type=float, default=0.01, help="доля пользователей, пополняющих баланс в сутки")
+    parser.add_argument("--recalc-sample", type=int, default=100, help="сколько recalc_subscription в сутки")
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="не удалять временную БД")
+    return parser.parse_args()
+
+
+args = parse_args()
+workdir = tempfile.mkdtemp(prefix="1vpn-sim-")
+db_path = os.path.join(workdir, "sim.db")
+if args.from_db:
+    shutil.copyfile(args.from_db, db_path)
+
+# настройки подменяются до импорта приложения: движок БД создаётся при импорте
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+for key, value in {
+    "BOT_TOKEN": "123456:simulator",
+    "WEBAPP_URL": "https://example.invalid",
+    "YOOKASSA_SHOP_ID": "sim",
+    "YOOKASSA_SECRET_KEY": "sim",
+    "ADMIN_SECRET": "sim",
+}.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import event, func, insert, select, update  # noqa: E402
+
+from app import main, models  # noqa: E402
+from app.database import AsyncSessionLocal, Base, engine  # noqa: E402
+from app.migrations import apply_migrations  # noqa: E402
+from app.utils import set_clock  # noqa: E402
+
+query_count = 0
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_queries(conn, cursor, statement, parameters, context, executemany):
+    global query_count
+    query_count += 1
+
+
+async def seed(rng: random.Random, price: float) -> None:
+    async with AsyncSessionLocal() as session:
+        session.add(models.RemSquad(name="sim", uuid="sim-squad", capacity=args.users * 2))
+        await session.commit()
+        batch = 10_000
+        now = main.now_utc()
+        for start in range(0, args.users, batch):
+            users = []
+            devices = []
+            for i in range(start, min(start + batch, args.users)):
+                user_id = i + 1
+                device_count = rng.choice((1, 1, 1, 2, 2, 3))
+                balance = int(rng.randint(0, args.max_days_balance) * price * device_count)
+                users.append(
+                    {
+                        "id": user_id,
+                        "telegram_id": str(10_000_000 + user_id),
+                        "link_slug": f"sim{user_id}",
+                        "balance": balance,
+                        "allowed_devices": device_count,
+                        "devices_count": device_count,
+                        "banned": False,
+                        "link_suspended": balance <= 0,
+                        "trial_claimed": True,
+                        "created_at": now,
+                        "updated_at": now,
+                    }
+                )
+                for d in range(device_count):
+                    devices.append({"user_id": user_id, "fingerprint": f"fp{user_id}-{d}", "label": "sim", "last_seen": now})
+            await session.execute(insert(models.User), users)
+            await session.execute(insert(models.Device), devices)
+            await session.commit()
+
+
+async def simulate_topups(rng: random.Random, price: float) -> int:
+    # часть пользователей пополняет баланс, чтобы модель не сводилась к одному оттоку
+    async with AsyncSessionLocal() as session:
+        max_id = await session.scalar(select(func.max(models.User.id))) or 0
+        if not max_id:
+            return 0
+        picked = rng.sample(range(1, max_id + 1), k=min(max_id, int(max_id * args.topup_rate)))
+        amount = int(price * 30)
+        if picked:
+            rows = (
+                await session.execute(select(models.User.id, models.User.balance).where(models.User.id.in_(picked)))
+            ).all()
+            await session.execute(update(models.User), [{"id": uid, "balance": balance + amount} for uid, balance in rows])
+            await session.execute(
+                insert(models.BalanceLedger),
+                [
+                    {"user_id": uid, "kind": models.LEDGER_TOPUP, "amount": amount, "balance_after": balance + amount, "comment": "sim"}
+                    for uid, balance in rows
+                ],
+            )
+            await session.commit()
+        return len(picked) * amount
+
+
+async def run() -> None:
+    global query_count
+    rng = random.Random(args.seed)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(apply_migrations)
+    async with AsyncSessionLocal() as session:
+        if args.price is not None:
+            await main.set_price(session, args.price)
+        price = await main.get_price(session)
+    if not args.from_db:
+        t0 = time.monotonic()
+        await seed(rng, price)
+        print(f"seeded {args.users} users in {time.monotonic() - t0:.1f}s")
+
+    start = main.now_utc().replace(hour=3, minute=0, second=0, microsecond=0)
+    totals = {"revenue": 0, "suspensions": 0, "topups": 0}
+    print(f"price={price} days={args.days} db={db_path}")
+    print("day        | bill_s  | queries | recalc_ms/user | active  | new_susp | revenue  | errors")
+    for day in range(args.days):
+        current = start + dt.timedelta(days=day)
+        set_clock(lambda current=current: current)
+        async with AsyncSessionLocal() as session:
+            active_before = await session.scalar(select(func.count(models.User.id)).where(models.User.link_suspended.is_(False)))
+
+        query_count = 0
+        t0 = time.monotonic()
+        report = await main.bill_users_once(concurrency=args.concurrency, dry_run=True) or {}
+        bill_time = time.monotonic() - t0
+        bill_queries = query_count
+
+        recalc_ms = 0.0
+        async with AsyncSessionLocal() as session:
+            max_id = await session.scalar(select(func.max(models.User.id))) or 0
+            sample_ids = rng.sample(range(1, max_id + 1), k=min(max_id, args.recalc_sample)) if max_id else []
+            t0 = time.monotonic()
+            for user_id in sample_ids:
+                user = await session.get(models.User, user_id)
+                if user:
+                    await main.recalc_subscription(session, user, dry_run=True)
+            if sample_ids:
+                recalc_ms = (time.monotonic() - t0) * 1000 / len(sample_ids)
+            active_after = await session.scalar(select(func.count(models.User.id)).where(models.User.link_suspended.is_(False)))
+
+        totals["topups"] += await simulate_topups(rng, price)
+        new_suspended = max(0, (active_before or 0) - (active_after or 0))
+        totals["revenue"] += report.get("revenue", 0)
+        totals["suspensions"] += new_suspended
+        print(
+            f"{current.date()} | {bill_time:7.2f} | {bill_queries:7d} | {recalc_ms:14.2f} | {active_after or 0:7d} "
+            f"| {new_suspended:8d} | {report.get('revenue', 0):8d} | {report.get('errors', 0)}"
+        )
+    set_clock(None)
+    print(f"total revenue={totals['revenue']} suspensions={totals['suspensions']} simulated topups={totals['topups']}")
+    await engine.dispose()
+
+
+try:
+    asyncio.run(run())
+finally:
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,95 @@
+"""
+Локальная заглушка API YooKassa для проверки оплаты и сверки зависших платежей без реального магазина.
+
+    python yookassa_stub.py --port 8790 --webhook-url http://127.0.0.1:8000/api/webhooks/yookassa
+    YOOKASSA_API_URL=http://127.0.0.1:8790/v3 uvicorn app.main:app
+
+Поддерживает POST /v3/payments и GET /v3/payments/{id}. Статус меняется вручную:
+
+    curl -X POST 'http://127.0.0.1:8790/stub/payments/<id>?status=succeeded'
+    curl -X POST 'http://127.0.0.1:8790/stub/payments/<id>?status=succeeded&webhook=0'   # «потерянный» webhook
+
+Без --webhook-url webhook не отправляется вовсе — платёж подхватит reconcile_payments_once.
+"""
+import argparse
+import datetime as dt
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+payments: dict[str, dict] = {}
+idempotency: dict[str, str] = {}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="YooKassa API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--webhook-url", default=None, help="куда слать payment.succeeded / payment.canceled")
+    return parser.parse_args()
+
+
+async def create_payment(request: web.Request) -> web.Response:
+    key = request.headers.get("Idempotence-Key")
+    if key and key in idempotency:
+        return web.json_response(payments[idempotency[key]])
+    body = await request.json()
+    payment_id = str(uuid.uuid4())
+    payment = {
+        "id": payment_id,
+        "status": "pending",
+        "paid": False,
+        "amount": body.get("amount"),
+        "description": body.get("description"),
+        "metadata": body.get("metadata") or {},
+        "confirmation": {
+            "type": "redirect",
+            "confirmation_url": f"http://{request.host}/stub/pay/{payment_id}",
+            "return_url": (body.get("confirmation") or {}).get("return_url"),
+        },
+        "created_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "test": True,
+        "refundable": False,
+    }
+    payments[payment_id] = payment
+    if key:
+        idempotency[key] = payment_id
+    return web.json_response(payment)
+
+
+async def get_payment(request: web.Request) -> web.Response:
+    payment = payments.get(request.match_info["payment_id"])
+    if not payment:
+        return web.json_response({"type": "error", "code": "not_found", "description": "Payment not found"}, status=404)
+    return web.json_response(payment)
+
+
+async def set_status(request: web.Request) -> web.Response:
+    payment = payments.get(request.match_info["payment_id"])
+    if not payment:
+        return web.json_response({"error": "not found"}, status=404)
+    status = request.query.get("status", "succeeded")
+    payment["status"] = status
+    payment["paid"] = status == "succeeded"
+    webhook_url = request.app["webhook_url"]
+    if webhook_url and request.query.get("webhook", "1") != "0":
+        event = {"type": "notification", "event": f"payment.{status}", "object": payment}
+        async with aiohttp.ClientSession() as http:
+            async with http.post(webhook_url, json=event) as resp:
+                print("webhook", resp.status, await resp.text())
+    return web.json_response(payment)
+
+
+def make_app(webhook_url: str | None = None) -> web.Application:
+    app = web.Application()
+    app["webhook_url"] = webhook_url
+    app.router.add_post("/v3/payments", create_payment)
+    app.router.add_get("/v3/payments/{payment_id}", get_payment)
+    app.router.add_post("/stub/payments/{payment_id}", set_status)
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(make_app(args.webhook_url), host=args.host, port=args.port)